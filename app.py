@@ -1,42 +1,127 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, Response
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, Response, g, has_app_context, stream_with_context, send_file
 import sqlite3
 from datetime import datetime, timedelta
 from functools import wraps
+from contextlib import contextmanager
+from abc import ABC, abstractmethod
 import csv
+import codecs
 import io
+import zlib
+import base64
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 import json
 import os
+import re
+import threading
+import time
+import queue
+import atexit
+import sys
+import multiprocessing
+import itertools
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections import OrderedDict, deque
+from markupsafe import Markup, escape
+import click
+from import_validation import IMPORT_COLUMNS, validate_import_chunk
 
 app = Flask(__name__)
 app.secret_key = 'pharmacy_advanced_secret_key_2024'
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 
-# Ensure upload folder exists
+# Write activity log and notification rows from a background thread (set True in tests)
+app.config['SYNC_AUDIT_WRITES'] = False
+
+# Background export files are written here and removed once they expire
+app.config['EXPORT_FOLDER'] = os.environ.get('EXPORT_FOLDER', 'exports')
+
+# Run large exports on a background thread pool (the Exports page)
+app.config['BACKGROUND_EXPORTS'] = True
+
+# Expiry alerts cover batches expiring within this many days
+app.config['EXPIRY_LOOKAHEAD_DAYS'] = int(os.environ.get('EXPIRY_LOOKAHEAD_DAYS', 30))
+
+# Hour of the day (local time) after which the nightly stock scan and snapshot run
+app.config['NIGHTLY_TASK_HOUR'] = int(os.environ.get('NIGHTLY_TASK_HOUR', 2))
+
+# Run nightly tasks on a background thread (set True to run them inside requests)
+app.config['SCHEDULER_INLINE'] = False
+
+# Worker processes for validating long CSV imports (0 or 1 validates in the request
+# thread). Each worker imports the app afresh, so this is off unless set.
+app.config['IMPORT_PROCESSES'] = int(os.environ.get('IMPORT_PROCESSES', 0))
+
+# Ensure upload and export folders exist
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+os.makedirs(app.config['EXPORT_FOLDER'], exist_ok=True)
 
 DB = 'pharmacy.db'
 
+# SQLite tuning applied to every new connection
+DB_BUSY_TIMEOUT_MS = 5000
+DB_CACHE_SIZE_KB = 16 * 1024      # page cache per connection (16MB)
+DB_MMAP_SIZE = 64 * 1024 * 1024   # memory-mapped I/O window (64MB)
+
 # === Database Helper ===
-def get_db():
-    conn = sqlite3.connect(DB)
+def connect_db():
+    """Open a new tuned SQLite connection (used directly outside of requests)"""
+    conn = sqlite3.connect(DB, timeout=DB_BUSY_TIMEOUT_MS / 1000)
     conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+    conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA temp_store=MEMORY")
     return conn
 
+@contextmanager
+def write_transaction(conn):
+    """Run the block in one BEGIN IMMEDIATE transaction: commit on success, roll back on error.
+    
+    Taking the write lock up front means rows read inside the block cannot be
+    changed by another writer before they are written. A block may call
+    conn.rollback() itself to discard its work.
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    if conn.in_transaction:
+        conn.commit()
+
+def get_db():
+    """Return the connection bound to the current request, opening it on first use"""
+    conn = getattr(g, '_database', None)
+    if conn is None:
+        conn = g._database = connect_db()
+    return conn
+
+@app.teardown_appcontext
+def close_db(exception):
+    conn = g.pop('_database', None)
+    if conn is not None:
+        if exception is not None and conn.in_transaction:
+            conn.rollback()
+        conn.close()
+
 def query_db(query, args=(), one=False):
     conn = get_db()
     cur = conn.cursor()
     cur.execute(query, args)
     result = cur.fetchall()
-    conn.commit()
-    conn.close()
+    if conn.in_transaction:
+        conn.commit()
     return (result[0] if result else None) if one else result
 
 def init_db():
     """Initialize database with all required tables"""
-    conn = get_db()
+    conn = connect_db()
     c = conn.cursor()
     
     # Admin table with enhanced fields
@@ -75,7 +160,7 @@ def init_db():
         FOREIGN KEY (supplier_id) REFERENCES suppliers(id)
     )''')
     
-    # Sales table with customer info
+    # Legacy per-line sales table (migration 3 converts it into a view over invoices/invoice_items)
     c.execute('''CREATE TABLE IF NOT EXISTS sales (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         invoice_number TEXT UNIQUE,
@@ -188,10 +273,454 @@ def init_db():
                  ('admin', hashed_pw, 'System Administrator', 'admin@pharmacy.com', 'admin'))
     
     conn.commit()
+    migrate_db(conn)
     conn.close()
 
-# Initialize database on startup
-init_db()
+# Per-day totals recomputed from invoice headers (used to backfill and to check daily_sales_summary)
+SALES_SUMMARY_ROLLUP = '''SELECT DATE(sale_date), SUM(total), SUM(item_count), COUNT(*), SUM(tax), SUM(discount)
+                          FROM invoices
+                          GROUP BY DATE(sale_date)'''
+
+# Trigger body that recomputes a medicine's stock columns from its batches: quantity is
+# the batch total; expiry_date/batch_number follow the next batch to sell (unexpired first)
+MEDICINE_BATCH_REFRESH = '''
+            UPDATE medicine SET quantity = (SELECT COALESCE(SUM(quantity), 0) FROM medicine_batches
+                                            WHERE medicine_id = {row}.medicine_id)
+            WHERE id = {row}.medicine_id;
+            UPDATE medicine SET (expiry_date, batch_number) = (
+                SELECT expiry_date, batch_number FROM medicine_batches
+                WHERE medicine_id = {row}.medicine_id AND quantity > 0
+                ORDER BY expiry_date < date('now'), expiry_date IS NULL, expiry_date, id LIMIT 1)
+            WHERE id = {row}.medicine_id
+              AND EXISTS (SELECT 1 FROM medicine_batches WHERE medicine_id = {row}.medicine_id AND quantity > 0);'''
+
+# Trigger body that appends a batch's quantity change to the stock ledger, valued at the
+# batch cost (falling back to the medicine's cost price)
+STOCK_MOVEMENT_INSERT = '''
+            INSERT INTO stock_movements (medicine_id, batch_id, quantity_change, unit_cost)
+            VALUES ({row}.medicine_id, {row}.id, {change},
+                    COALESCE({row}.cost_price, (SELECT cost_price FROM medicine WHERE id = {row}.medicine_id)));'''
+
+# Current quantity and value of the medicines in {moved} (medicine_id, last_movement_id),
+# valued the same way as STOCK_MOVEMENT_INSERT so snapshots and movements add up
+STOCK_SNAPSHOT_ROWS = '''WITH moved (medicine_id, last_movement_id) AS ({moved})
+                         SELECT m.id, m.quantity,
+                                COALESCE(SUM(b.quantity * COALESCE(b.cost_price, m.cost_price)), 0),
+                                moved.last_movement_id
+                         FROM moved
+                         JOIN medicine m ON m.id = moved.medicine_id
+                         LEFT JOIN medicine_batches b ON b.medicine_id = m.id
+                         GROUP BY m.id'''
+
+# === Schema Migrations ===
+# Each entry is (version, description, statements). Pending migrations run in
+# order at startup, each in its own transaction, and are recorded in
+# schema_version. Never edit a migration once released - append a new one.
+MIGRATIONS = [
+    (1, 'Secondary indexes for hot queries', [
+        # dashboard / sales_report / export_sales / analytics date filters
+        "CREATE INDEX IF NOT EXISTS idx_sales_sale_date ON sales(sale_date)",
+        # analytics GROUP BY medicine and joins from medicine to its sales
+        "CREATE INDEX IF NOT EXISTS idx_sales_medicine_id ON sales(medicine_id)",
+        # customer purchase history lookups
+        "CREATE INDEX IF NOT EXISTS idx_sales_customer_id ON sales(customer_id)",
+        # per-cashier sales lookups
+        "CREATE INDEX IF NOT EXISTS idx_sales_cashier_id ON sales(cashier_id)",
+        # dashboard counts and /expired ranges
+        "CREATE INDEX IF NOT EXISTS idx_medicine_expiry_date ON medicine(expiry_date)",
+        # /medicines category filter and the DISTINCT category dropdown
+        "CREATE INDEX IF NOT EXISTS idx_medicine_category ON medicine(category)",
+        # ORDER BY name on /medicines, /pos, /inventory_adjustment, /create_po
+        "CREATE INDEX IF NOT EXISTS idx_medicine_name ON medicine(name)",
+        # purchase order line items
+        "CREATE INDEX IF NOT EXISTS idx_po_items_po_id ON po_items(po_id)",
+        # /activity_log ORDER BY timestamp DESC LIMIT 100
+        "CREATE INDEX IF NOT EXISTS idx_activity_log_timestamp ON activity_log(timestamp)",
+        # dashboard unread notifications ORDER BY created_at DESC LIMIT 5
+        "CREATE INDEX IF NOT EXISTS idx_notifications_unread ON notifications(is_read, created_at)",
+    ]),
+    (2, 'Covering index for sales date-range totals', [
+        # SUM(total_price)/SUM(quantity) over a sale_date range is answered from the index alone;
+        # it also serves every lookup the plain sale_date index did
+        "CREATE INDEX IF NOT EXISTS idx_sales_date_totals ON sales(sale_date, total_price, quantity)",
+        "DROP INDEX IF EXISTS idx_sales_sale_date",
+    ]),
+    (3, 'Invoice header and line item tables', [
+        '''CREATE TABLE invoices (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            invoice_number TEXT UNIQUE NOT NULL,
+            customer_id INTEGER,
+            cashier_id INTEGER,
+            payment_method TEXT,
+            item_count INTEGER DEFAULT 0,
+            subtotal REAL DEFAULT 0,
+            discount REAL DEFAULT 0,
+            tax REAL DEFAULT 0,
+            total REAL DEFAULT 0,
+            sale_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (customer_id) REFERENCES customers(id),
+            FOREIGN KEY (cashier_id) REFERENCES admin(id)
+        )''',
+        '''CREATE TABLE invoice_items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            invoice_id INTEGER NOT NULL,
+            medicine_id INTEGER,
+            quantity INTEGER,
+            unit_price REAL,
+            discount REAL DEFAULT 0,
+            tax REAL DEFAULT 0,
+            total_price REAL,
+            prescription_required INTEGER DEFAULT 0,
+            prescription_number TEXT,
+            FOREIGN KEY (invoice_id) REFERENCES invoices(id),
+            FOREIGN KEY (medicine_id) REFERENCES medicine(id)
+        )''',
+        # One header per legacy invoice number (rows without one become their own invoice)
+        '''INSERT INTO invoices (invoice_number, customer_id, cashier_id, payment_method, item_count,
+                                 subtotal, discount, tax, total, sale_date)
+           SELECT COALESCE(invoice_number, 'LEGACY' || MIN(id)), customer_id, cashier_id, payment_method,
+                  SUM(quantity), SUM(unit_price * quantity), SUM(unit_price * quantity * discount / 100),
+                  SUM(tax), SUM(total_price), MIN(sale_date)
+           FROM sales
+           GROUP BY COALESCE(invoice_number, 'LEGACY' || id)
+           ORDER BY MIN(id)''',
+        '''INSERT INTO invoice_items (id, invoice_id, medicine_id, quantity, unit_price, discount, tax,
+                                      total_price, prescription_required, prescription_number)
+           SELECT s.id, i.id, s.medicine_id, s.quantity, s.unit_price, s.discount, s.tax,
+                  s.total_price, s.prescription_required, s.prescription_number
+           FROM sales s
+           JOIN invoices i ON i.invoice_number = COALESCE(s.invoice_number, 'LEGACY' || s.id)''',
+        "DROP TABLE sales",
+        # Line-level compatibility view so reports and analytics keep reading `sales`
+        '''CREATE VIEW sales AS
+           SELECT ii.id, i.invoice_number, i.customer_id, ii.medicine_id, ii.quantity, ii.unit_price,
+                  ii.discount, ii.tax, ii.total_price, i.payment_method, i.sale_date, i.cashier_id,
+                  ii.prescription_required, ii.prescription_number, ii.invoice_id
+           FROM invoice_items ii
+           JOIN invoices i ON i.id = ii.invoice_id''',
+        "CREATE INDEX idx_invoices_date_totals ON invoices(sale_date, total, item_count)",
+        "CREATE INDEX idx_invoices_customer_id ON invoices(customer_id)",
+        "CREATE INDEX idx_invoices_cashier_id ON invoices(cashier_id)",
+        "CREATE INDEX idx_invoice_items_invoice_id ON invoice_items(invoice_id)",
+        "CREATE INDEX idx_invoice_items_medicine_id ON invoice_items(medicine_id)",
+    ]),
+    (4, 'Full-text search index over medicine names, brands and barcodes', [
+        # External-content FTS5 table: stores only the index, rows are read from medicine
+        '''CREATE VIRTUAL TABLE medicine_fts USING fts5(
+            name, brand, generic_name, barcode,
+            content='medicine', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        )''',
+        '''CREATE TRIGGER medicine_fts_insert AFTER INSERT ON medicine BEGIN
+            INSERT INTO medicine_fts (rowid, name, brand, generic_name, barcode)
+            VALUES (new.id, new.name, new.brand, new.generic_name, new.barcode);
+        END''',
+        '''CREATE TRIGGER medicine_fts_delete AFTER DELETE ON medicine BEGIN
+            INSERT INTO medicine_fts (medicine_fts, rowid, name, brand, generic_name, barcode)
+            VALUES ('delete', old.id, old.name, old.brand, old.generic_name, old.barcode);
+        END''',
+        # Only text edits touch the index; stock updates from the till do not
+        '''CREATE TRIGGER medicine_fts_update AFTER UPDATE OF name, brand, generic_name, barcode ON medicine BEGIN
+            INSERT INTO medicine_fts (medicine_fts, rowid, name, brand, generic_name, barcode)
+            VALUES ('delete', old.id, old.name, old.brand, old.generic_name, old.barcode);
+            INSERT INTO medicine_fts (rowid, name, brand, generic_name, barcode)
+            VALUES (new.id, new.name, new.brand, new.generic_name, new.barcode);
+        END''',
+        "INSERT INTO medicine_fts (medicine_fts) VALUES ('rebuild')",
+    ]),
+    (5, 'Indexes for keyset-paginated list pages', [
+        # /medicines sort options (quantity is left out: it changes on every sale)
+        "CREATE INDEX IF NOT EXISTS idx_medicine_brand ON medicine(brand)",
+        "CREATE INDEX IF NOT EXISTS idx_medicine_price ON medicine(price)",
+        "CREATE INDEX IF NOT EXISTS idx_customers_name ON customers(name)",
+        "CREATE INDEX IF NOT EXISTS idx_suppliers_name ON suppliers(name)",
+        "CREATE INDEX IF NOT EXISTS idx_purchase_orders_order_date ON purchase_orders(order_date)",
+    ]),
+    (6, 'Daily sales summary maintained by the checkout', [
+        '''CREATE TABLE daily_sales_summary (
+            sale_day DATE PRIMARY KEY,
+            revenue REAL DEFAULT 0,
+            items INTEGER DEFAULT 0,
+            invoice_count INTEGER DEFAULT 0,
+            tax REAL DEFAULT 0,
+            discount REAL DEFAULT 0
+        )''',
+        f"INSERT INTO daily_sales_summary {SALES_SUMMARY_ROLLUP}",
+    ]),
+    (7, 'Coalesced per-medicine alerts and notification paging', [
+        "ALTER TABLE notifications ADD COLUMN medicine_id INTEGER REFERENCES medicine(id)",
+        "ALTER TABLE notifications ADD COLUMN occurrences INTEGER DEFAULT 1",
+        # At most one alert of each type per medicine; create_notification() upserts into it
+        '''CREATE UNIQUE INDEX idx_notifications_alert ON notifications(type, medicine_id)
+           WHERE medicine_id IS NOT NULL''',
+        # /notifications keyset paging and the read-notification retention purge
+        "CREATE INDEX idx_notifications_created_at ON notifications(created_at)",
+    ]),
+    (8, 'Background export jobs', [
+        '''CREATE TABLE jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            params TEXT,
+            status TEXT DEFAULT 'queued',
+            progress INTEGER DEFAULT 0,
+            total INTEGER,
+            file_path TEXT,
+            file_name TEXT,
+            error TEXT,
+            created_by INTEGER REFERENCES admin(id),
+            created_at TIMESTAMP,
+            finished_at TIMESTAMP,
+            expires_at TIMESTAMP
+        )''',
+        # Per-user job list, newest first
+        "CREATE INDEX idx_jobs_created_by ON jobs(created_by, created_at)",
+        # Expiry cleanup
+        "CREATE INDEX idx_jobs_expires_at ON jobs(expires_at)",
+    ]),
+    (9, 'Batch/lot-level stock with first-expiry-first-out allocation', [
+        '''CREATE TABLE medicine_batches (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            medicine_id INTEGER NOT NULL REFERENCES medicine(id),
+            batch_number TEXT,
+            expiry_date DATE,
+            quantity INTEGER NOT NULL DEFAULT 0,
+            cost_price REAL,
+            received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''',
+        # FEFO picking walks a medicine's batches in expiry order
+        "CREATE INDEX idx_medicine_batches_fefo ON medicine_batches(medicine_id, expiry_date)",
+        # One row per lot, so stock received into an existing lot is added to it (NULLs compare equal here)
+        '''CREATE UNIQUE INDEX idx_medicine_batches_lot
+           ON medicine_batches(medicine_id, COALESCE(batch_number, ''), COALESCE(expiry_date, ''))''',
+        # Expired / expiring reports only look at batches that still hold stock
+        "CREATE INDEX idx_medicine_batches_expiry ON medicine_batches(expiry_date) WHERE quantity > 0",
+        '''INSERT INTO medicine_batches (medicine_id, batch_number, expiry_date, quantity, cost_price)
+           SELECT id, batch_number, expiry_date, quantity, cost_price FROM medicine WHERE quantity > 0''',
+        f"CREATE TRIGGER medicine_batches_insert AFTER INSERT ON medicine_batches BEGIN {MEDICINE_BATCH_REFRESH.format(row='new')} END",
+        f'''CREATE TRIGGER medicine_batches_update AFTER UPDATE OF quantity, expiry_date, batch_number ON medicine_batches
+           BEGIN {MEDICINE_BATCH_REFRESH.format(row='new')} END''',
+        f"CREATE TRIGGER medicine_batches_delete AFTER DELETE ON medicine_batches BEGIN {MEDICINE_BATCH_REFRESH.format(row='old')} END",
+        # New medicines (form, CSV import) open with a single batch holding their starting stock
+        '''CREATE TRIGGER medicine_opening_batch AFTER INSERT ON medicine WHEN new.quantity > 0 BEGIN
+            INSERT INTO medicine_batches (medicine_id, batch_number, expiry_date, quantity, cost_price)
+            VALUES (new.id, new.batch_number, new.expiry_date, new.quantity, new.cost_price);
+        END''',
+        '''CREATE TRIGGER medicine_delete_batches AFTER DELETE ON medicine BEGIN
+            DELETE FROM medicine_batches WHERE medicine_id = old.id;
+        END''',
+    ]),
+    (10, 'Append-only stock movement ledger with periodic snapshots', [
+        '''CREATE TABLE stock_movements (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            medicine_id INTEGER NOT NULL,
+            batch_id INTEGER,
+            quantity_change INTEGER NOT NULL,
+            unit_cost REAL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''',
+        # Point-in-time lookups read one medicine's movements after its snapshot
+        "CREATE INDEX idx_stock_movements_medicine ON stock_movements(medicine_id, created_at)",
+        '''CREATE TABLE stock_snapshots (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            medicine_id INTEGER NOT NULL,
+            quantity INTEGER NOT NULL,
+            value REAL NOT NULL,
+            last_movement_id INTEGER NOT NULL,
+            taken_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''',
+        # Nearest snapshot at or before a given time
+        "CREATE INDEX idx_stock_snapshots_medicine ON stock_snapshots(medicine_id, taken_at)",
+        # Opening balances: history starts from the stock held when the ledger was added
+        f"INSERT INTO stock_snapshots (medicine_id, quantity, value, last_movement_id) {STOCK_SNAPSHOT_ROWS.format(moved='SELECT id, 0 FROM medicine')}",
+        # Every batch quantity change is recorded, whichever route made it
+        f'''CREATE TRIGGER stock_movements_batch_insert AFTER INSERT ON medicine_batches WHEN new.quantity != 0
+           BEGIN {STOCK_MOVEMENT_INSERT.format(row='new', change='new.quantity')} END''',
+        f'''CREATE TRIGGER stock_movements_batch_update AFTER UPDATE OF quantity ON medicine_batches
+           WHEN new.quantity != old.quantity
+           BEGIN {STOCK_MOVEMENT_INSERT.format(row='new', change='new.quantity - old.quantity')} END''',
+        f'''CREATE TRIGGER stock_movements_batch_delete AFTER DELETE ON medicine_batches WHEN old.quantity != 0
+           BEGIN {STOCK_MOVEMENT_INSERT.format(row='old', change='-old.quantity')} END''',
+        '''CREATE TRIGGER stock_movements_no_update BEFORE UPDATE ON stock_movements
+           BEGIN SELECT RAISE(ABORT, 'stock_movements is append-only'); END''',
+        '''CREATE TRIGGER stock_movements_no_delete BEFORE DELETE ON stock_movements
+           BEGIN SELECT RAISE(ABORT, 'stock_movements is append-only'); END''',
+    ]),
+    (11, 'Stock reconciliation against sales and adjustments', [
+        # Opening balances (the snapshots taken when the ledger was added) for reconciliation
+        "CREATE INDEX idx_stock_snapshots_opening ON stock_snapshots(medicine_id) WHERE last_movement_id = 0",
+        "CREATE INDEX idx_inventory_adjustments_date ON inventory_adjustments(adjustment_date)",
+        # Record a new medicine's starting stock, so sales and adjustments account for all of it
+        '''CREATE TRIGGER medicine_opening_adjustment AFTER INSERT ON medicine WHEN new.quantity > 0 BEGIN
+            INSERT INTO inventory_adjustments (medicine_id, adjustment_type, quantity_change, reason)
+            VALUES (new.id, 'add', new.quantity, 'Opening stock');
+        END''',
+    ]),
+    (12, 'Nightly stock alert scan and scheduled task runs', [
+        # Expired / expiring batches and low-stock medicines found by the last scan
+        '''CREATE TABLE stock_alerts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            medicine_id INTEGER NOT NULL,
+            batch_id INTEGER,
+            expiry_date DATE,
+            quantity INTEGER,
+            scanned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''',
+        # Per-kind pages and counts, and the scan's "is this alert new?" check
+        "CREATE INDEX idx_stock_alerts_kind ON stock_alerts(kind, medicine_id)",
+        '''CREATE TABLE task_runs (
+            name TEXT PRIMARY KEY,
+            last_run_at TIMESTAMP
+        )''',
+    ]),
+    (13, 'Indexed low-stock flag', [
+        # ALTER TABLE can only add VIRTUAL generated columns; the partial index stores the
+        # flagged rows, so low-stock lookups and counts touch only those medicines
+        '''ALTER TABLE medicine ADD COLUMN is_low_stock INTEGER
+           GENERATED ALWAYS AS (quantity < reorder_level) VIRTUAL''',
+        # /low_stock ORDER BY quantity and the dashboard count
+        "CREATE INDEX idx_medicine_low_stock ON medicine(quantity) WHERE is_low_stock",
+    ]),
+    (14, 'Cost value of written-off stock', [
+        "ALTER TABLE inventory_adjustments ADD COLUMN cost_value REAL",
+    ]),
+]
+
+def migrate_db(conn):
+    """Apply pending MIGRATIONS to an open connection"""
+    conn.execute('''CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        description TEXT,
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''')
+    
+    for version, description, statements in MIGRATIONS:
+        # Take the write lock before checking, so concurrent workers apply each migration once
+        with write_transaction(conn):
+            applied = conn.execute("SELECT 1 FROM schema_version WHERE version=?", (version,)).fetchone()
+            if not applied:
+                for statement in statements:
+                    conn.execute(statement)
+                conn.execute("INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                             (version, description))
+
+# === Invoice Numbers ===
+def next_invoice_number(c):
+    """Reserve the next invoice id and number; call inside the checkout's write transaction.
+    
+    Numbers are derived from the AUTOINCREMENT sequence of `invoices`, which
+    never reuses a value, so they are unique across tills and strictly increasing.
+    """
+    c.execute("SELECT seq FROM sqlite_sequence WHERE name='invoices'")
+    row = c.fetchone()
+    invoice_id = (row['seq'] if row else 0) + 1
+    return invoice_id, f"INV{datetime.now().strftime('%Y%m%d')}-{invoice_id:06d}"
+
+# === Date Range Helpers ===
+def date_range_bounds(start_date, end_date=None):
+    """Turn an inclusive YYYY-MM-DD date range into half-open [start, end) bounds.
+    
+    Filtering with `sale_date >= ? AND sale_date < ?` keeps the column bare so
+    SQLite can use the sale_date index, unlike `DATE(sale_date) BETWEEN ? AND ?`.
+    """
+    start = datetime.strptime(start_date, '%Y-%m-%d')
+    end = datetime.strptime(end_date or start_date, '%Y-%m-%d') + timedelta(days=1)
+    return start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')
+
+def report_date_range():
+    """Read start_date/end_date args or form fields (default: month to date) with their bounds"""
+    default_start = datetime.today().replace(day=1).strftime('%Y-%m-%d')
+    default_end = datetime.today().strftime('%Y-%m-%d')
+    start_date = request.values.get('start_date') or default_start
+    end_date = request.values.get('end_date') or default_end
+    
+    try:
+        bounds = date_range_bounds(start_date, end_date)
+    except ValueError:
+        flash('Invalid date range, showing this month instead.', 'warning')
+        start_date, end_date = default_start, default_end
+        bounds = date_range_bounds(start_date, end_date)
+    
+    return start_date, end_date, bounds
+
+# === Search Helpers ===
+# bm25 column weights for medicine_fts: name, brand, generic_name, barcode
+MEDICINE_FTS_RANK = "bm25(medicine_fts, 10.0, 5.0, 3.0, 1.0)"
+
+def fts_prefix_query(term):
+    """Build an FTS5 MATCH expression in which every word of `term` must match as a prefix"""
+    return ' '.join(f'"{token}"*' for token in re.findall(r'\w+', term))
+
+# === Keyset Pagination ===
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+def encode_cursor(value, row_id):
+    return base64.urlsafe_b64encode(json.dumps([value, row_id]).encode()).decode()
+
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        value, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return value, int(row_id)
+    except (ValueError, TypeError):
+        return None
+
+def keyset_condition(column, id_column, cursor, descending):
+    """SQL predicate selecting rows after `cursor` in (column, id) order, NULLs sorting first"""
+    value, row_id = cursor
+    if not descending:
+        if value is None:
+            return f"({column} IS NULL AND {id_column} > ?) OR {column} IS NOT NULL", [row_id]
+        return f"{column} >= ? AND ({column} > ? OR {id_column} > ?)", [value, value, row_id]
+    if value is None:
+        return f"{column} IS NULL AND {id_column} < ?", [row_id]
+    return f"({column} <= ? AND ({column} < ? OR {id_column} < ?)) OR {column} IS NULL", [value, value, row_id]
+
+def keyset_page(query, args, sort_column, descending=False, id_column='id'):
+    """Fetch one page of `query` ordered by (sort_column, id_column).
+    
+    `query` must already have a WHERE clause. Reads the `after`/`before` cursors
+    and `per_page` from the request and returns (rows, pagination), where
+    pagination holds per_page and the next/prev page URLs (None at either end).
+    """
+    per_page = min(max(request.args.get('per_page', DEFAULT_PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+    after = decode_cursor(request.args.get('after'))
+    before = decode_cursor(request.args.get('before')) if after is None else None
+    cursor = after or before
+    
+    # A previous page is the next page in the opposite order, flipped afterwards
+    backwards = before is not None
+    scan_descending = descending != backwards
+    args = list(args)
+    if cursor:
+        condition, cursor_args = keyset_condition(sort_column, id_column, cursor, scan_descending)
+        query += f" AND ({condition})"
+        args.extend(cursor_args)
+    
+    direction = 'DESC' if scan_descending else 'ASC'
+    query += f" ORDER BY {sort_column} {direction}, {id_column} {direction} LIMIT ?"
+    args.append(per_page + 1)
+    
+    rows = query_db(query, args)
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backwards:
+        rows.reverse()
+    
+    sort_field, id_field = sort_column.split('.')[-1], id_column.split('.')[-1]
+    params = {key: value for key, value in request.args.items() if key not in ('after', 'before')}
+    params['per_page'] = per_page
+    next_url = prev_url = None
+    if rows and (backwards or has_more):
+        next_url = url_for(request.endpoint, **params,
+                           after=encode_cursor(rows[-1][sort_field], rows[-1][id_field]))
+    if rows and (has_more if backwards else cursor is not None):
+        prev_url = url_for(request.endpoint, **params,
+                           before=encode_cursor(rows[0][sort_field], rows[0][id_field]))
+    
+    return rows, {'per_page': per_page, 'next_url': next_url, 'prev_url': prev_url}
 
 # === Login Required Decorator ===
 def login_required(f):
@@ -203,15 +732,637 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+# === Background Threads ===
+class BackgroundWorker(ABC):
+    """Owns one daemon thread running self._run, started on first use.
+    
+    Forked worker processes do not inherit threads, so _ensure_started() also
+    starts a fresh thread when the process id has changed since the last start.
+    """
+    thread_name = 'background-worker'
+    
+    def __init__(self):
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+    
+    def _running_here(self):
+        return self._thread is not None and self._thread.is_alive() and self._pid == os.getpid()
+    
+    def _ensure_started(self):
+        if self._running_here():
+            return
+        with self._lock:
+            if not self._running_here():
+                if self._pid != os.getpid():
+                    self._after_fork()
+                    self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name=self.thread_name, daemon=True)
+                self._thread.start()
+    
+    def _after_fork(self):
+        """Reset state copied from the parent process (called before the first start in a process)"""
+    
+    @abstractmethod
+    def _run(self):
+        """The thread body; returns when the worker is stopped"""
+
+# === Background Audit Writer ===
+AUDIT_QUEUE_SIZE = 10000
+AUDIT_BATCH_SIZE = 500
+AUDIT_RETRIES = 3  # Attempts per batch before falling back to row-by-row writes
+AUDIT_STOP_TIMEOUT = 10
+
+class AuditWriter(BackgroundWorker):
+    """Batches activity_log and notification inserts into few transactions on a background thread.
+    
+    Rows are queued as (sql, params, cache tags). When the queue is full, or
+    when SYNC_AUDIT_WRITES is set (tests, serverless), rows are written inline.
+    """
+    
+    thread_name = 'audit-writer'
+    
+    def __init__(self, maxsize=AUDIT_QUEUE_SIZE, batch_size=AUDIT_BATCH_SIZE):
+        super().__init__()
+        self.batch_size = batch_size
+        self._queue = queue.Queue(maxsize)
+    
+    def submit(self, sql, params, tags=()):
+        item = (sql, params, tags)
+        if app.config.get('SYNC_AUDIT_WRITES'):
+            self._write_inline([item])
+            return
+        
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self._write_inline([item])
+    
+    def flush(self):
+        """Block until every queued row has been written"""
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.join()
+    
+    def stop(self):
+        """Write the queued rows, as flush() does, then end the thread (registered with atexit).
+        
+        Unlike flush(), a writer that cannot drain within AUDIT_STOP_TIMEOUT is abandoned
+        so a stuck database cannot hang the exit.
+        """
+        if self._thread is not None and self._thread.is_alive():
+            try:
+                # A full queue means the writer is stuck; give up rather than hang the exit
+                self._queue.put(None, timeout=AUDIT_STOP_TIMEOUT)
+            except queue.Full:
+                app.logger.warning("Audit writer did not drain; %d rows not written", self._queue.qsize())
+                return
+            self._thread.join(timeout=AUDIT_STOP_TIMEOUT)
+    
+    def _after_fork(self):
+        # Rows queued before a fork belong to the parent process
+        self._queue = queue.Queue(self._queue.maxsize)
+    
+    def _run(self):
+        conn = connect_db()
+        stopping = False
+        while not stopping:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            
+            if None in batch:
+                stopping = True
+            items = [item for item in batch if item is not None]
+            try:
+                if items:
+                    self._write_with_retry(conn, items)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+        conn.close()
+    
+    def _write_with_retry(self, conn, items):
+        # A busy database (e.g. a long stock take) is retried; if the batch still fails,
+        # write the rows one at a time so a single bad row does not lose the rest
+        for attempt in range(AUDIT_RETRIES):
+            try:
+                self._write_batch(conn, items)
+                return
+            except sqlite3.OperationalError:
+                app.logger.warning("Audit batch of %d rows failed (attempt %d)", len(items), attempt + 1)
+                time.sleep(0.5 * (attempt + 1))
+            except Exception:
+                break
+        
+        for item in items:
+            try:
+                self._write_batch(conn, [item])
+            except Exception:
+                app.logger.exception("Failed to write audit row: %s %r", item[0].split('(')[0].strip(), item[1])
+    
+    def _write_inline(self, items):
+        if has_app_context():
+            self._write_batch(get_db(), items)
+        else:
+            conn = connect_db()
+            try:
+                self._write_batch(conn, items)
+            finally:
+                conn.close()
+    
+    @staticmethod
+    def _write_batch(conn, items):
+        # Runs of the same statement go through executemany; one commit for the whole batch
+        with conn:
+            start = 0
+            while start < len(items):
+                end = start
+                while end < len(items) and items[end][0] == items[start][0]:
+                    end += 1
+                conn.executemany(items[start][0], [item[1] for item in items[start:end]])
+                start = end
+        invalidate_cache(*{tag for item in items for tag in item[2]})
+
+audit_writer = AuditWriter()
+atexit.register(audit_writer.stop)
+
 # === Log Activity ===
 def log_activity(action, details=''):
     if 'admin_id' in session:
-        query_db('''INSERT INTO activity_log (user_id, action, details) 
-                    VALUES (?, ?, ?)''', (session['admin_id'], action, details))
+        audit_writer.submit('''INSERT INTO activity_log (user_id, action, details) 
+                               VALUES (?, ?, ?)''', (session['admin_id'], action, details))
 
 # === Create Notification ===
-def create_notification(type, message):
-    query_db('''INSERT INTO notifications (type, message) VALUES (?, ?)''', (type, message))
+NOTIFICATION_RETENTION_DAYS = 30
+
+def create_notification(type, message, medicine_id=None):
+    """Queue a notification; alerts about a medicine replace its previous alert of the same type"""
+    if medicine_id is None:
+        audit_writer.submit('''INSERT INTO notifications (type, message) VALUES (?, ?)''', (type, message),
+                            tags=('notifications',))
+        return
+    
+    audit_writer.submit('''INSERT INTO notifications (type, message, medicine_id) VALUES (?, ?, ?)
+                           ON CONFLICT(type, medicine_id) WHERE medicine_id IS NOT NULL DO UPDATE SET
+                               message = excluded.message,
+                               is_read = 0,
+                               created_at = CURRENT_TIMESTAMP,
+                               occurrences = occurrences + 1''',
+                        (type, message, medicine_id), tags=('notifications',))
+
+def purge_read_notifications(conn, days=NOTIFICATION_RETENTION_DAYS):
+    """Delete notifications that were read and are older than the retention window"""
+    with conn:
+        deleted = conn.execute("DELETE FROM notifications WHERE is_read = 1 AND created_at < datetime('now', ?)",
+                               (f'-{days} days',)).rowcount
+    invalidate_cache('notifications')
+    return deleted
+
+# === Query Cache ===
+CACHE_MAX_ENTRIES = 256
+CACHE_TTL = 60  # seconds
+
+class QueryCache:
+    """Thread-safe LRU cache with per-entry TTLs and invalidation tags.
+    
+    Write routes call invalidate_cache() with the tags they affect; TTLs bound
+    staleness across worker processes, which each keep their own cache.
+    """
+    
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()   # key -> (expires_at, tags, value)
+        self._tag_versions = {}
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+    
+    def get_or_load(self, key, loader, ttl=CACHE_TTL, tags=()):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+            versions = [self._tag_versions.get(tag, 0) for tag in tags]
+        
+        value = loader()
+        
+        with self._lock:
+            # Skip storing if a write invalidated one of the tags while loading
+            if versions == [self._tag_versions.get(tag, 0) for tag in tags]:
+                self._entries[key] = (time.monotonic() + ttl, frozenset(tags), value)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+        return value
+    
+    def invalidate(self, *tags):
+        tags = set(tags)
+        with self._lock:
+            for tag in tags:
+                self._tag_versions[tag] = self._tag_versions.get(tag, 0) + 1
+            stale = [key for key, entry in self._entries.items() if entry[1] & tags]
+            for key in stale:
+                del self._entries[key]
+            self.invalidations += len(stale)
+    
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self._entries), 'max_entries': self.max_entries,
+                    'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+                    'evictions': self.evictions, 'invalidations': self.invalidations}
+
+query_cache = QueryCache()
+
+def cached_query(query, args=(), one=False, tags=(), ttl=CACHE_TTL):
+    """query_db() through the cache; `tags` name the data the result depends on"""
+    key = (query, tuple(args), one)
+    return query_cache.get_or_load(key, lambda: query_db(query, args, one), ttl=ttl, tags=tags)
+
+def invalidate_cache(*tags):
+    query_cache.invalidate(*tags)
+
+# === Barcode Lookup Index ===
+# In-process map of barcode -> the medicine fields the till needs, so a scan
+# never touches the database. It is built lazily with a single query; writes
+# either drop it entirely or refresh just the medicine rows they changed.
+# Each entry keeps the (expiry_date, quantity) of the medicine's lots with stock,
+# so what is still sellable is worked out at scan time and follows the calendar.
+_barcode_index = None
+_barcode_ids = {}
+_barcode_generation = 0
+_barcode_lock = threading.Lock()
+
+BARCODE_INDEX_QUERY = ("SELECT id, name, brand, generic_name, price, quantity, expiry_date, barcode, "
+                       "(SELECT json_group_array(json_array(expiry_date, quantity)) FROM medicine_batches "
+                       " WHERE medicine_id = medicine.id AND quantity > 0) as lots "
+                       "FROM medicine WHERE barcode IS NOT NULL AND barcode != ''")
+
+def barcode_entry(row):
+    entry = dict(row)
+    entry['lots'] = [tuple(lot) for lot in json.loads(entry['lots'])]
+    return entry
+
+def get_barcode_index():
+    global _barcode_index, _barcode_ids
+    index = _barcode_index
+    if index is not None:
+        return index
+    
+    generation = _barcode_generation
+    rows = query_db(BARCODE_INDEX_QUERY)
+    index = {row['barcode']: barcode_entry(row) for row in rows}
+    with _barcode_lock:
+        # Only publish if no write invalidated the index while it was loading
+        if generation == _barcode_generation:
+            _barcode_index = index
+            _barcode_ids = {entry['id']: barcode for barcode, entry in index.items()}
+    return index
+
+def invalidate_barcode_index(medicine_ids=None):
+    """Drop the whole barcode index, or reload only the given medicine ids into it"""
+    global _barcode_index, _barcode_generation
+    if medicine_ids is None or _barcode_index is None:
+        with _barcode_lock:
+            _barcode_generation += 1
+            _barcode_index = None
+        return
+    
+    medicine_ids = list(medicine_ids)
+    placeholders = ','.join('?' * len(medicine_ids))
+    rows = query_db(f"{BARCODE_INDEX_QUERY} AND id IN ({placeholders})", medicine_ids)
+    with _barcode_lock:
+        if _barcode_index is None:
+            return
+        for medicine_id in medicine_ids:
+            old_barcode = _barcode_ids.pop(medicine_id, None)
+            if old_barcode is not None:
+                _barcode_index.pop(old_barcode, None)
+        for row in rows:
+            _barcode_index[row['barcode']] = barcode_entry(row)
+            _barcode_ids[row['id']] = row['barcode']
+
+# === Stock Batches ===
+# medicine_batches holds stock per lot. Triggers keep medicine.quantity equal to the
+# batch total, so stock changes go through these helpers rather than medicine.quantity.
+
+BATCH_RECEIVE = '''INSERT INTO medicine_batches (medicine_id, batch_number, expiry_date, quantity, cost_price)
+                   VALUES (?, ?, ?, ?, ?)
+                   ON CONFLICT(medicine_id, COALESCE(batch_number, ''), COALESCE(expiry_date, ''))
+                   DO UPDATE SET quantity = quantity + excluded.quantity'''
+
+# Adds (quantity, medicine_id) stock to the medicine's most recently received lot
+BATCH_RECEIVE_LATEST_LOT = '''INSERT INTO medicine_batches (medicine_id, batch_number, expiry_date, quantity, cost_price)
+                              SELECT m.id, COALESCE(b.batch_number, m.batch_number),
+                                     COALESCE(b.expiry_date, m.expiry_date), ?, m.cost_price
+                              FROM medicine m
+                              LEFT JOIN medicine_batches b
+                                     ON b.id = (SELECT MAX(id) FROM medicine_batches WHERE medicine_id = m.id)
+                              WHERE m.id = ?
+                              ON CONFLICT(medicine_id, COALESCE(batch_number, ''), COALESCE(expiry_date, ''))
+                              DO UPDATE SET quantity = quantity + excluded.quantity'''
+
+# The next unexpired batch to sell (the one MEDICINE_BATCH_REFRESH shows on the medicine),
+# which is the batch relabelled when its expiry or batch number is corrected. Expired
+# batches are never relabelled, so a correction cannot make expired stock sellable again.
+BATCH_TO_RELABEL = '''SELECT id, quantity FROM medicine_batches
+                      WHERE medicine_id = ? AND quantity > 0 AND (expiry_date IS NULL OR expiry_date >= date('now'))
+                      ORDER BY expiry_date IS NULL, expiry_date, id LIMIT 1'''
+
+# Units of medicine `m` a till can sell: the stock in its unexpired batches
+SELLABLE_QUANTITY = '''(SELECT COALESCE(SUM(b.quantity), 0) FROM medicine_batches b
+                        WHERE b.medicine_id = m.id AND b.quantity > 0
+                          AND (b.expiry_date IS NULL OR b.expiry_date >= date('now')))'''
+# ...and the earliest expiry among them, as the barcode scan reports it
+SELLABLE_EXPIRY = '''(SELECT MIN(b.expiry_date) FROM medicine_batches b
+                      WHERE b.medicine_id = m.id AND b.quantity > 0 AND b.expiry_date >= date('now'))'''
+
+# The medicine's lot with the given (batch_number, expiry_date), if any
+BATCH_LOT = '''SELECT id FROM medicine_batches
+               WHERE medicine_id = ? AND COALESCE(batch_number, '') = COALESCE(?, '')
+                 AND COALESCE(expiry_date, '') = COALESCE(?, '')'''
+
+# Plans first-expiry-first-out picks for every requested medicine in one pass: a running
+# total over each medicine's batches in expiry order decides how much each batch gives
+FEFO_ALLOCATION = '''
+    WITH wanted (medicine_id, quantity) AS (SELECT CAST(key AS INTEGER), value FROM json_each(?)),
+    ranked AS (
+        SELECT b.id, b.medicine_id, b.quantity, w.quantity as wanted,
+               SUM(b.quantity) OVER (PARTITION BY b.medicine_id
+                                     ORDER BY b.expiry_date IS NULL, b.expiry_date, b.id) - b.quantity as before
+        FROM wanted w
+        JOIN medicine_batches b ON b.medicine_id = w.medicine_id
+        WHERE b.quantity > 0 AND (? OR b.expiry_date IS NULL OR b.expiry_date >= ?)
+    )
+    SELECT id, medicine_id, MIN(quantity, wanted - before) as take
+    FROM ranked
+    WHERE before < wanted
+'''
+
+def receive_stock(c, medicine_id, quantity, batch_number=None, expiry_date=None, cost_price=None):
+    """Add stock to a medicine's lot, opening the lot if it does not exist yet"""
+    c.execute(BATCH_RECEIVE, (medicine_id, batch_number or None, expiry_date or None, quantity, cost_price))
+
+def relabel_batch(c, medicine_id, batch_number=None, expiry_date=None):
+    """Give the next unexpired batch a new batch number / expiry date.
+    
+    If another lot already has those labels the batch is merged into it, as the two
+    are now the same lot. Returns False when there is no unexpired stock to relabel.
+    """
+    batch = c.execute(BATCH_TO_RELABEL, (medicine_id,)).fetchone()
+    if batch is None:
+        return False
+    
+    lot = c.execute(BATCH_LOT, (medicine_id, batch_number, expiry_date)).fetchone()
+    if lot is None:
+        c.execute("UPDATE medicine_batches SET batch_number = ?, expiry_date = ? WHERE id = ?",
+                  (batch_number, expiry_date, batch['id']))
+    elif lot['id'] != batch['id']:
+        c.execute("UPDATE medicine_batches SET quantity = quantity + ? WHERE id = ?", (batch['quantity'], lot['id']))
+        c.execute("DELETE FROM medicine_batches WHERE id = ?", (batch['id'],))
+    return True
+
+def allocate_fefo(c, quantities, include_expired=False):
+    """Take {medicine_id: quantity} from batches, earliest expiry first.
+    
+    Expired batches are skipped unless include_expired is set. Returns the
+    {medicine_id: missing units} that could not be covered; in that case
+    nothing is taken.
+    """
+    today = datetime.today().strftime('%Y-%m-%d')
+    picks = c.execute(FEFO_ALLOCATION, (json.dumps({str(k): v for k, v in quantities.items()}),
+                                        1 if include_expired else 0, today)).fetchall()
+    
+    allocated = {}
+    for pick in picks:
+        allocated[pick['medicine_id']] = allocated.get(pick['medicine_id'], 0) + pick['take']
+    shortfalls = {medicine_id: quantity - allocated.get(medicine_id, 0)
+                  for medicine_id, quantity in quantities.items() if allocated.get(medicine_id, 0) < quantity}
+    if shortfalls:
+        return shortfalls
+    
+    c.executemany("UPDATE medicine_batches SET quantity = quantity - ? WHERE id = ?",
+                  [(pick['take'], pick['id']) for pick in picks])
+    return {}
+
+# === Stock Ledger ===
+# stock_movements gets a row (via triggers) for every batch quantity change. Snapshots
+# checkpoint each medicine's balance so a point-in-time lookup only replays the
+# movements since the nearest snapshot. Snapshots are taken nightly by the scheduler.
+
+# Medicines deleted since :at were still held back then, so stock_at takes the medicine
+# ids from the ledger as well as the medicine table
+STOCK_AT_MEDICINES = (('medicine', 'id'), ('stock_snapshots', 'medicine_id'), ('stock_movements', 'medicine_id'))
+
+# Stock quantity and value per medicine just before :at, from the latest snapshot taken
+# before :at plus the movements recorded after it
+STOCK_AT = '''
+    WITH ids (medicine_id) AS ({ids}),
+    base AS (
+        SELECT ids.medicine_id, s.quantity, s.value, s.taken_at,
+               COALESCE(s.last_movement_id, 0) as last_movement_id
+        FROM ids
+        LEFT JOIN stock_snapshots s ON s.id = (SELECT id FROM stock_snapshots
+                                              WHERE medicine_id = ids.medicine_id AND taken_at < :at
+                                              ORDER BY taken_at DESC, id DESC LIMIT 1)
+    )
+    SELECT base.medicine_id as id, COALESCE(m.name, 'Deleted medicine #' || base.medicine_id) as name,
+           m.brand, m.barcode, m.id IS NULL as deleted,
+           COALESCE(base.quantity, 0) + COALESCE(SUM(sm.quantity_change), 0) as quantity,
+           COALESCE(base.value, 0) + COALESCE(SUM(sm.quantity_change * sm.unit_cost), 0) as value,
+           COUNT(sm.id) as movements_replayed
+    FROM base
+    LEFT JOIN medicine m ON m.id = base.medicine_id
+    LEFT JOIN stock_movements sm ON sm.medicine_id = base.medicine_id
+                                AND sm.created_at >= COALESCE(base.taken_at, '')
+                                AND sm.created_at < :at
+                                AND sm.id > base.last_movement_id
+    GROUP BY base.medicine_id
+    ORDER BY m.id IS NULL, name
+'''
+
+def snapshot_stock(conn):
+    """Snapshot the balance of every medicine that moved since the last snapshot.
+    
+    Returns the number of medicines snapshotted.
+    """
+    with write_transaction(conn):
+        last = conn.execute("SELECT COALESCE(MAX(last_movement_id), 0) as last_movement_id FROM stock_snapshots").fetchone()
+        moved = "SELECT medicine_id, MAX(id) FROM stock_movements WHERE id > ? GROUP BY medicine_id"
+        taken = conn.execute(f"INSERT INTO stock_snapshots (medicine_id, quantity, value, last_movement_id) "
+                             f"{STOCK_SNAPSHOT_ROWS.format(moved=moved)}", (last['last_movement_id'],)).rowcount
+    return taken
+
+def stock_at(conn, at, medicine_id=None):
+    """Stock quantity and value per medicine as it stood just before `at` (YYYY-MM-DD[ HH:MM:SS])"""
+    where = '' if medicine_id is None else ' WHERE {column} = :medicine_id'
+    ids = ' UNION '.join(f"SELECT {column} FROM {table}{where.format(column=column)}"
+                         for table, column in STOCK_AT_MEDICINES)
+    return conn.execute(STOCK_AT.format(ids=ids), {'at': at, 'medicine_id': medicine_id}).fetchall()
+
+# === Stock Alerts ===
+# A nightly scan stores expired / expiring batches and low-stock medicines in stock_alerts,
+# which the dashboard and Expired/Expiring page read instead of scanning batches on every load.
+# Low stock pages use the live is_low_stock column; its alerts here only drive notifications.
+
+# Every alert in one pass over medicine: its batches expiring by :horizon, and the
+# medicine itself when it is below its reorder level
+STOCK_ALERT_SCAN = '''
+    WITH scan AS MATERIALIZED (
+        SELECT m.id as medicine_id, m.name, m.quantity as stock, m.reorder_level,
+               b.id as batch_id, b.expiry_date, b.quantity
+        FROM medicine m
+        LEFT JOIN medicine_batches b ON b.medicine_id = m.id AND b.quantity > 0 AND b.expiry_date <= :horizon
+    )
+    SELECT CASE WHEN expiry_date < :today THEN 'expired' ELSE 'expiring' END as kind,
+           medicine_id, name, batch_id, expiry_date, quantity
+    FROM scan
+    WHERE batch_id IS NOT NULL
+    UNION ALL
+    SELECT DISTINCT 'low_stock', medicine_id, name, NULL, NULL, stock
+    FROM scan
+    WHERE stock < reorder_level
+'''
+
+# One notification per medicine and kind that the previous scan did not already report
+STOCK_ALERT_NOTIFY = '''
+    INSERT INTO notifications (type, message, medicine_id)
+    SELECT kind,
+           CASE kind WHEN 'expired' THEN name || ' has ' || SUM(quantity) || ' expired units'
+                     WHEN 'expiring' THEN name || ': ' || SUM(quantity) || ' units expire by ' || MAX(expiry_date)
+                     ELSE name || ' is running low (Stock: ' || MAX(quantity) || ')' END,
+           medicine_id
+    FROM temp.stock_alert_scan s
+    WHERE NOT EXISTS (SELECT 1 FROM stock_alerts a WHERE a.kind = s.kind AND a.medicine_id = s.medicine_id)
+    GROUP BY kind, medicine_id
+    ON CONFLICT(type, medicine_id) WHERE medicine_id IS NOT NULL DO UPDATE SET
+        message = excluded.message,
+        is_read = 0,
+        created_at = CURRENT_TIMESTAMP,
+        occurrences = occurrences + 1
+'''
+
+def expiry_horizon():
+    """Last expiry date (YYYY-MM-DD) that counts as expiring soon"""
+    return (datetime.today() + timedelta(days=app.config['EXPIRY_LOOKAHEAD_DAYS'])).strftime('%Y-%m-%d')
+
+def scan_stock_alerts(conn):
+    """Rebuild stock_alerts and notify about alerts the previous scan did not have.
+    
+    Returns the number of alerts of each kind.
+    """
+    params = {'today': datetime.today().strftime('%Y-%m-%d'), 'horizon': expiry_horizon()}
+    with write_transaction(conn):
+        conn.execute("DROP TABLE IF EXISTS temp.stock_alert_scan")
+        conn.execute(f"CREATE TEMP TABLE stock_alert_scan AS {STOCK_ALERT_SCAN}", params)
+        conn.execute(STOCK_ALERT_NOTIFY)
+        conn.execute("DELETE FROM stock_alerts")
+        conn.execute('''INSERT INTO stock_alerts (kind, medicine_id, batch_id, expiry_date, quantity)
+                        SELECT kind, medicine_id, batch_id, expiry_date, quantity FROM temp.stock_alert_scan''')
+        conn.execute("DROP TABLE temp.stock_alert_scan")
+        conn.execute('''INSERT INTO task_runs (name, last_run_at) VALUES ('stock_alerts', ?)
+                        ON CONFLICT(name) DO UPDATE SET last_run_at = excluded.last_run_at''',
+                     (datetime.now().strftime('%Y-%m-%d %H:%M:%S'),))
+        counts = dict(conn.execute("SELECT kind, COUNT(*) FROM stock_alerts GROUP BY kind").fetchall())
+    invalidate_cache('stock', 'notifications')
+    return counts
+
+# === Nightly Scheduler ===
+SCHEDULER_POLL_SECONDS = 300
+
+class NightlyScheduler(BackgroundWorker):
+    """Runs registered maintenance tasks once a night, after NIGHTLY_TASK_HOUR.
+    
+    Each run is claimed in task_runs before it starts, so with several worker
+    processes a task still runs once. A background thread polls for due tasks;
+    with SCHEDULER_INLINE set (serverless), the request that notices a due task
+    runs it instead.
+    """
+    
+    thread_name = 'nightly-scheduler'
+    
+    def __init__(self, poll_seconds=SCHEDULER_POLL_SECONDS):
+        super().__init__()
+        self.poll_seconds = poll_seconds
+        self._tasks = {}
+        self._stopping = threading.Event()
+        self._next_check = 0
+    
+    def task(self, name):
+        """Register a function(conn) to run nightly under `name`"""
+        def register(func):
+            self._tasks[name] = func
+            return func
+        return register
+    
+    def ensure_running(self):
+        if app.config.get('SCHEDULER_INLINE'):
+            if time.monotonic() >= self._next_check:
+                self._next_check = time.monotonic() + self.poll_seconds
+                self.run_due()
+            return
+        self._ensure_started()
+    
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join(timeout=10)
+    
+    def run_due(self):
+        """Run every task whose nightly run has not been claimed yet"""
+        conn = connect_db()
+        try:
+            for name, func in self._tasks.items():
+                if not self._claim(conn, name):
+                    continue
+                try:
+                    func(conn)
+                except Exception:
+                    app.logger.exception("Nightly task %s failed", name)
+        finally:
+            conn.close()
+    
+    @staticmethod
+    def _claim(conn, name):
+        now = datetime.now()
+        due_at = now.replace(hour=app.config['NIGHTLY_TASK_HOUR'], minute=0, second=0, microsecond=0)
+        if due_at > now:
+            due_at -= timedelta(days=1)
+        with conn:
+            return conn.execute('''INSERT INTO task_runs (name, last_run_at) VALUES (?, ?)
+                                   ON CONFLICT(name) DO UPDATE SET last_run_at = excluded.last_run_at
+                                   WHERE last_run_at IS NULL OR last_run_at < ?''',
+                                (name, now.strftime('%Y-%m-%d %H:%M:%S'),
+                                 due_at.strftime('%Y-%m-%d %H:%M:%S'))).rowcount == 1
+    
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                self.run_due()
+            except Exception:
+                app.logger.exception("Nightly scheduler check failed")
+            self._stopping.wait(self.poll_seconds)
+
+scheduler = NightlyScheduler()
+atexit.register(scheduler.stop)
+scheduler.task('stock_alerts')(scan_stock_alerts)
+scheduler.task('stock_snapshot')(snapshot_stock)
+scheduler.task('purge_notifications')(purge_read_notifications)
+
+@app.before_request
+def run_scheduler():
+    scheduler.ensure_running()
+
+# Initialize database on startup (after the helpers it relies on are defined)
+init_db()
 
 # === Routes ===
 
@@ -246,29 +1397,35 @@ def login():
 @app.route('/dashboard')
 @login_required
 def dashboard():
-    # Get statistics
-    total_medicines = query_db("SELECT COUNT(*) as count FROM medicine", one=True)['count']
-    low_stock = query_db("SELECT COUNT(*) as count FROM medicine WHERE quantity < reorder_level", one=True)['count']
+    # Get statistics (cached until stock changes)
+    total_medicines = cached_query("SELECT COUNT(*) as count FROM medicine", one=True, tags=('stock',))['count']
+    
+    low_stock = cached_query("SELECT COUNT(*) as count FROM medicine WHERE is_low_stock",
+                             one=True, tags=('stock',))['count']
+    
+    # Medicines with expired / expiring batches, from the nightly scan
+    alert_counts = {row['kind']: row['count'] for row in cached_query(
+        "SELECT kind, COUNT(DISTINCT medicine_id) as count FROM stock_alerts GROUP BY kind", tags=('stock',))}
+    expired = alert_counts.get('expired', 0)
+    expiring_soon = alert_counts.get('expiring', 0)
     
     today = datetime.today().strftime('%Y-%m-%d')
-    expired = query_db("SELECT COUNT(*) as count FROM medicine WHERE expiry_date < ?", (today,), one=True)['count']
-    expiring_soon = query_db("SELECT COUNT(*) as count FROM medicine WHERE expiry_date BETWEEN ? AND ?", 
-                             (today, (datetime.today() + timedelta(days=30)).strftime('%Y-%m-%d')), one=True)['count']
     
-    # Sales statistics
-    today_sales = query_db('''SELECT COALESCE(SUM(total_price), 0) as total 
-                              FROM sales 
-                              WHERE DATE(sale_date) = ?''', (today,), one=True)['total']
+    # Sales statistics (one summary row per day, cached until the next sale)
+    today_sales = cached_query('''SELECT COALESCE(SUM(revenue), 0) as total 
+                                  FROM daily_sales_summary 
+                                  WHERE sale_day = ?''', (today,), one=True, tags=('sales',))['total']
     
     month_start = datetime.today().replace(day=1).strftime('%Y-%m-%d')
-    month_sales = query_db('''SELECT COALESCE(SUM(total_price), 0) as total 
-                              FROM sales 
-                              WHERE DATE(sale_date) >= ?''', (month_start,), one=True)['total']
+    month_sales = cached_query('''SELECT COALESCE(SUM(revenue), 0) as total 
+                                  FROM daily_sales_summary 
+                                  WHERE sale_day >= ?''', (month_start,), one=True, tags=('sales',))['total']
     
-    # Recent sales
+    # Recent sales (lines of the latest invoices, found through the header index)
     recent_sales = query_db('''
         SELECT s.*, m.name, c.name as customer_name 
-        FROM sales s
+        FROM (SELECT id FROM invoices ORDER BY sale_date DESC LIMIT 10) recent
+        JOIN sales s ON s.invoice_id = recent.id
         JOIN medicine m ON s.medicine_id = m.id
         LEFT JOIN customers c ON s.customer_id = c.id
         ORDER BY s.sale_date DESC
@@ -276,13 +1433,15 @@ def dashboard():
     ''')
     
     # Unread notifications
-    notifications = query_db("SELECT * FROM notifications WHERE is_read=0 ORDER BY created_at DESC LIMIT 5")
+    notifications = cached_query("SELECT * FROM notifications WHERE is_read=0 ORDER BY created_at DESC LIMIT 5",
+                                 tags=('notifications',))
     
     return render_template('dashboard.html',
                          total_medicines=total_medicines,
                          low_stock=low_stock,
                          expired=expired,
                          expiring_soon=expiring_soon,
+                         lookahead_days=app.config['EXPIRY_LOOKAHEAD_DAYS'],
                          today_sales=today_sales,
                          month_sales=month_sales,
                          recent_sales=recent_sales,
@@ -296,15 +1455,15 @@ def medicines():
     search = request.args.get('search', '').strip()
     category = request.args.get('category', '').strip()
     sort_by = request.args.get('sort', 'name')
-    order = request.args.get('order', 'ASC')
+    order = 'DESC' if request.args.get('order', 'ASC').upper() == 'DESC' else 'ASC'
     
     base_query = "SELECT * FROM medicine WHERE 1=1"
     args = []
     
-    if search:
-        base_query += " AND (name LIKE ? OR brand LIKE ? OR generic_name LIKE ? OR barcode LIKE ?)"
-        search_term = f'%{search}%'
-        args.extend([search_term, search_term, search_term, search_term])
+    match = fts_prefix_query(search)
+    if match:
+        base_query += " AND id IN (SELECT rowid FROM medicine_fts WHERE medicine_fts MATCH ?)"
+        args.append(match)
     
     if category:
         base_query += " AND category = ?"
@@ -312,11 +1471,12 @@ def medicines():
     
     # Sorting
     allowed_sorts = ['name', 'brand', 'quantity', 'price', 'expiry_date']
-    if sort_by in allowed_sorts:
-        base_query += f" ORDER BY {sort_by} {order}"
+    if sort_by not in allowed_sorts:
+        sort_by = 'name'
     
-    meds = query_db(base_query, args)
-    categories = query_db("SELECT DISTINCT category FROM medicine WHERE category IS NOT NULL")
+    meds, pagination = keyset_page(base_query, args, sort_by, descending=(order == 'DESC'))
+    categories = cached_query("SELECT DISTINCT category FROM medicine WHERE category IS NOT NULL",
+                              tags=('catalog',), ttl=300)
     
     return render_template('medicines.html', 
                          medicines=meds, 
@@ -324,7 +1484,8 @@ def medicines():
                          selected_category=category, 
                          search=search,
                          sort_by=sort_by,
-                         order=order)
+                         order=order,
+                         pagination=pagination)
 
 @app.route('/add_medicine', methods=['GET', 'POST'])
 @login_required
@@ -345,40 +1506,75 @@ def add_medicine():
                   request.form.get('description'), 
                   1 if request.form.get('requires_prescription') else 0))
         
+        invalidate_barcode_index()
+        invalidate_cache('catalog', 'stock')
         log_activity('Add Medicine', f"Added medicine: {request.form['name']}")
         flash(f"Medicine '{request.form['name']}' added successfully!", 'success')
         return redirect(url_for('medicines'))
     
-    suppliers = query_db("SELECT * FROM suppliers ORDER BY name")
+    suppliers = cached_query("SELECT * FROM suppliers ORDER BY name", tags=('suppliers',), ttl=300)
     return render_template('add_medicine.html', suppliers=suppliers)
 
 @app.route('/edit_medicine/<int:med_id>', methods=['GET', 'POST'])
 @login_required
 def edit_medicine(med_id):
     if request.method == 'POST':
-        query_db('''UPDATE medicine
-                    SET name=?, generic_name=?, brand=?, category=?, supplier_id=?, 
-                        quantity=?, reorder_level=?, cost_price=?, price=?, expiry_date=?, 
-                        barcode=?, batch_number=?, rack_location=?, description=?,
-                        requires_prescription=?, updated_at=?
-                    WHERE id=?''',
-                 (request.form['name'], request.form.get('generic_name'),
-                  request.form['brand'], request.form['category'],
-                  request.form.get('supplier_id') or None,
-                  request.form['quantity'], request.form.get('reorder_level', 10),
-                  request.form.get('cost_price'), request.form['price'],
-                  request.form['expiry_date'], request.form.get('barcode'),
-                  request.form.get('batch_number'), request.form.get('rack_location'),
-                  request.form.get('description'),
-                  1 if request.form.get('requires_prescription') else 0,
-                  datetime.now(), med_id))
+        conn = get_db()
+        # The read and the writes share one transaction so a sale cannot land in between
+        with write_transaction(conn):
+            current = conn.execute("SELECT quantity, expiry_date, batch_number FROM medicine WHERE id=?",
+                                   (med_id,)).fetchone()
+            if current is None:
+                flash('That medicine no longer exists.', 'danger')
+                return redirect(url_for('medicines'))
+            conn.execute('''UPDATE medicine
+                        SET name=?, generic_name=?, brand=?, category=?, supplier_id=?, 
+                            quantity=?, reorder_level=?, cost_price=?, price=?, expiry_date=?, 
+                            barcode=?, batch_number=?, rack_location=?, description=?,
+                            requires_prescription=?, updated_at=?
+                        WHERE id=?''',
+                     (request.form['name'], request.form.get('generic_name'),
+                      request.form['brand'], request.form['category'],
+                      request.form.get('supplier_id') or None,
+                      request.form['quantity'], request.form.get('reorder_level', 10),
+                      request.form.get('cost_price'), request.form['price'],
+                      request.form['expiry_date'], request.form.get('barcode'),
+                      request.form.get('batch_number'), request.form.get('rack_location'),
+                      request.form.get('description'),
+                      1 if request.form.get('requires_prescription') else 0,
+                      datetime.now(), med_id))
+        
+            # Mirror the form onto the batches: a new expiry/batch number relabels the current
+            # batch, and a quantity change is received into or taken from the batches
+            expiry_date = request.form['expiry_date'] or None
+            batch_number = request.form.get('batch_number') or None
+            change = int(request.form['quantity']) - current['quantity']
+            if (expiry_date, batch_number) != (current['expiry_date'], current['batch_number']):
+                if not relabel_batch(conn, med_id, batch_number, expiry_date) and change <= 0:
+                    flash('There is no unexpired stock to relabel; the new batch and expiry apply to stock received next.',
+                          'warning')
+            if change > 0:
+                receive_stock(conn, med_id, change, batch_number, expiry_date, request.form.get('cost_price') or None)
+            elif change < 0:
+                allocate_fefo(conn, {med_id: -change}, include_expired=True)
+            if change:
+                conn.execute('''INSERT INTO inventory_adjustments 
+                                (medicine_id, adjustment_type, quantity_change, reason, adjusted_by)
+                                VALUES (?, ?, ?, ?, ?)''',
+                             (med_id, 'add' if change > 0 else 'subtract', abs(change),
+                              'Edited on medicine form', session['admin_id']))
         
+        invalidate_barcode_index([med_id])
+        invalidate_cache('catalog', 'stock')
         log_activity('Edit Medicine', f"Updated medicine ID: {med_id}")
         flash('Medicine updated successfully!', 'success')
         return redirect(url_for('medicines'))
     
     medicine = query_db('SELECT * FROM medicine WHERE id=?', (med_id,), one=True)
-    suppliers = query_db("SELECT * FROM suppliers ORDER BY name")
+    if medicine is None:
+        flash('That medicine no longer exists.', 'danger')
+        return redirect(url_for('medicines'))
+    suppliers = cached_query("SELECT * FROM suppliers ORDER BY name", tags=('suppliers',), ttl=300)
     return render_template('edit_medicine.html', medicine=medicine, suppliers=suppliers)
 
 @app.route('/delete_medicine/<int:med_id>')
@@ -386,22 +1582,30 @@ def edit_medicine(med_id):
 def delete_medicine(med_id):
     medicine = query_db("SELECT name FROM medicine WHERE id=?", (med_id,), one=True)
     query_db("DELETE FROM medicine WHERE id=?", (med_id,))
+    invalidate_barcode_index([med_id])
+    invalidate_cache('catalog', 'stock')
     log_activity('Delete Medicine', f"Deleted medicine: {medicine['name']}")
     flash(f"Medicine '{medicine['name']}' deleted successfully!", 'success')
     return redirect(url_for('medicines'))
 
 # === Point of Sale ===
 
+# Page size for the till's medicine search
+POS_SEARCH_LIMIT = 20
+POS_SEARCH_MAX_LIMIT = 50
+
 @app.route('/pos', methods=['GET', 'POST'])
 @login_required
 def pos():
     if request.method == 'POST':
         data = request.get_json()
         
-        # Generate invoice number
-        invoice_number = f"INV{datetime.now().strftime('%Y%m%d%H%M%S')}"
-        
         total_amount = 0
+        total_quantity = 0
+        subtotal_amount = 0
+        discount_total = 0
+        tax_total = 0
+        low_stock_alerts = []
         customer_id = data.get('customer_id') or None
         payment_method = data.get('payment_method', 'cash')
         
@@ -409,48 +1613,99 @@ def pos():
         c = conn.cursor()
         
         try:
-            for item in data['items']:
-                medicine_id = item['medicine_id']
-                quantity = int(item['quantity'])
-                discount = float(item.get('discount', 0))
-                
-                # Get medicine details
-                c.execute("SELECT * FROM medicine WHERE id=?", (medicine_id,))
-                med = c.fetchone()
-                
-                if not med:
-                    conn.close()
-                    return jsonify({'success': False, 'message': 'Medicine not found'}), 400
+            items = data.get('items') or []
+            if not items:
+                return jsonify({'success': False, 'message': 'Cart is empty'}), 400
+            
+            # Take the write lock before reading stock so two tills cannot sell the same units
+            with write_transaction(conn):
+                # Load every medicine in the cart with a single query
+                medicine_ids = sorted({int(item['medicine_id']) for item in items})
+                placeholders = ','.join('?' * len(medicine_ids))
+                c.execute(f'''SELECT m.id, m.name, m.price, m.quantity, m.reorder_level,
+                                     {SELLABLE_QUANTITY} as sellable
+                              FROM medicine m WHERE m.id IN ({placeholders})''', medicine_ids)
+                meds = {med['id']: med for med in c.fetchall()}
                 
-                if med['quantity'] < quantity:
-                    conn.close()
-                    return jsonify({'success': False, 'message': f'Insufficient stock for {med["name"]}'}), 400
+                sale_rows = []
+                sold = {}
+                for item in items:
+                    medicine_id = int(item['medicine_id'])
+                    quantity = int(item['quantity'])
+                    discount = float(item.get('discount', 0))
+                    med = meds.get(medicine_id)
+                    
+                    if not med:
+                        conn.rollback()
+                        return jsonify({'success': False, 'message': 'Medicine not found'}), 400
+                    
+                    if quantity <= 0:
+                        conn.rollback()
+                        return jsonify({'success': False, 'message': f'Invalid quantity for {med["name"]}'}), 400
+                    
+                    sold[medicine_id] = sold.get(medicine_id, 0) + quantity
+                    if med['sellable'] < sold[medicine_id]:
+                        conn.rollback()
+                        return jsonify({'success': False, 'message': f'Insufficient stock for {med["name"]}'}), 400
+                    
+                    # Calculate prices
+                    unit_price = med['price']
+                    subtotal = unit_price * quantity
+                    discount_amount = subtotal * (discount / 100)
+                    tax = (subtotal - discount_amount) * 0.05  # 5% tax
+                    total_price = subtotal - discount_amount + tax
+                    total_amount += total_price
+                    total_quantity += quantity
+                    subtotal_amount += subtotal
+                    discount_total += discount_amount
+                    tax_total += tax
+                    
+                    sale_rows.append((medicine_id, quantity, unit_price, discount, tax, total_price))
                 
-                # Calculate prices
-                unit_price = med['price']
-                subtotal = unit_price * quantity
-                discount_amount = subtotal * (discount / 100)
-                tax = (subtotal - discount_amount) * 0.05  # 5% tax
-                total_price = subtotal - discount_amount + tax
-                total_amount += total_price
+                # Take stock from the earliest-expiring unexpired batches, every cart line in one pass
+                shortfalls = allocate_fefo(c, sold)
+                if shortfalls:
+                    conn.rollback()
+                    name = meds[next(iter(shortfalls))]['name']
+                    return jsonify({'success': False, 'message': f'Insufficient unexpired stock for {name}'}), 409
                 
-                # Update stock
-                c.execute("UPDATE medicine SET quantity = quantity - ? WHERE id = ?", (quantity, medicine_id))
+                for medicine_id, quantity in sold.items():
+                    # Check if stock is low
+                    med = meds[medicine_id]
+                    if med['quantity'] - quantity < med['reorder_level']:
+                        low_stock_alerts.append((medicine_id,
+                                                 f"{med['name']} is running low (Stock: {med['quantity'] - quantity})"))
                 
-                # Insert sale record
-                c.execute('''INSERT INTO sales 
-                            (invoice_number, customer_id, medicine_id, quantity, unit_price, 
-                             discount, tax, total_price, payment_method, cashier_id)
+                # Insert the invoice header, then all of its line items
+                invoice_id, invoice_number = next_invoice_number(c)
+                c.execute('''INSERT INTO invoices 
+                            (id, invoice_number, customer_id, cashier_id, payment_method, item_count,
+                             subtotal, discount, tax, total)
                             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                         (invoice_number, customer_id, medicine_id, quantity, unit_price,
-                          discount, tax, total_price, payment_method, session['admin_id']))
+                         (invoice_id, invoice_number, customer_id, session['admin_id'], payment_method,
+                          total_quantity, subtotal_amount, discount_total, tax_total, total_amount))
+                
+                c.executemany('''INSERT INTO invoice_items 
+                                (invoice_id, medicine_id, quantity, unit_price, discount, tax, total_price)
+                                VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                             [(invoice_id,) + row for row in sale_rows])
                 
-                # Check if stock is low
-                if med['quantity'] - quantity < med['reorder_level']:
-                    create_notification('low_stock', f"{med['name']} is running low (Stock: {med['quantity'] - quantity})")
+                # Roll the invoice into its day's summary within the same transaction
+                c.execute('''INSERT INTO daily_sales_summary (sale_day, revenue, items, invoice_count, tax, discount)
+                            SELECT DATE(sale_date), total, item_count, 1, tax, discount FROM invoices WHERE id = ?
+                            ON CONFLICT(sale_day) DO UPDATE SET
+                                revenue = revenue + excluded.revenue,
+                                items = items + excluded.items,
+                                invoice_count = invoice_count + 1,
+                                tax = tax + excluded.tax,
+                                discount = discount + excluded.discount''', (invoice_id,))
             
-            conn.commit()
-            conn.close()
+            invalidate_barcode_index(sold.keys())
+            invalidate_cache('stock', 'sales')
+            
+            # Notify only after the sale has committed so the write lock is not held twice
+            for medicine_id, message in low_stock_alerts:
+                create_notification('low_stock', message, medicine_id=medicine_id)
             
             log_activity('Sale', f"Invoice: {invoice_number}, Amount: {total_amount:.2f}")
             
@@ -462,22 +1717,80 @@ def pos():
             })
             
         except Exception as e:
-            conn.rollback()
-            conn.close()
             return jsonify({'success': False, 'message': str(e)}), 500
     
-    # GET request
-    medicines = query_db("SELECT * FROM medicine WHERE quantity > 0 AND expiry_date >= date('now') ORDER BY name")
-    customers = query_db("SELECT * FROM customers ORDER BY name")
-    return render_template('pos.html', medicines=medicines, customers=customers)
+    # GET request - medicines are fetched page by page through /api/medicines/search
+    customers = cached_query("SELECT * FROM customers ORDER BY name", tags=('customers',), ttl=300)
+    return render_template('pos.html', customers=customers, search_limit=POS_SEARCH_LIMIT)
+
+@app.route('/api/medicines/search')
+@login_required
+def search_medicines_api():
+    q = request.args.get('q', '').strip()
+    limit = min(max(request.args.get('limit', POS_SEARCH_LIMIT, type=int), 1), POS_SEARCH_MAX_LIMIT)
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    
+    # Quantity and expiry are the sellable stock's, the same figures as a barcode scan
+    columns = (f"m.id, m.name, m.generic_name, m.brand, m.price, {SELLABLE_QUANTITY} as quantity, "
+               f"m.reorder_level, {SELLABLE_EXPIRY} as expiry_date, m.barcode")
+    # Sellable: at least one unexpired batch still holds stock
+    in_stock = ('''m.quantity > 0 AND EXISTS (SELECT 1 FROM medicine_batches b
+                                                WHERE b.medicine_id = m.id AND b.quantity > 0
+                                                  AND (b.expiry_date IS NULL OR b.expiry_date >= date('now')))''')
+    match = fts_prefix_query(q)
+    
+    if match:
+        # Prefix matches from the full-text index, best bm25 score first (name weighs most)
+        query = f'''SELECT {columns}
+                    FROM medicine_fts
+                    JOIN medicine m ON m.id = medicine_fts.rowid
+                    WHERE medicine_fts MATCH ? AND {in_stock}
+                    ORDER BY {MEDICINE_FTS_RANK}, m.name, m.id'''
+        args = [match]
+    else:
+        query = f"SELECT {columns} FROM medicine m WHERE {in_stock} ORDER BY m.name, m.id"
+        args = []
+    
+    # Fetch one extra row to know whether another page exists
+    query += " LIMIT ? OFFSET ?"
+    args.extend([limit + 1, offset])
+    rows = query_db(query, args)
+    
+    return jsonify({
+        'success': True,
+        'results': [dict(row) for row in rows[:limit]],
+        'has_more': len(rows) > limit,
+        'next_offset': offset + limit
+    })
+
+@app.route('/api/medicine/by_barcode/<code>')
+@login_required
+def medicine_by_barcode(code):
+    med = get_barcode_index().get(code.strip())
+    
+    if not med:
+        return jsonify({'success': False, 'message': f'No medicine found for barcode {code}'}), 404
+    
+    if not med['lots']:
+        return jsonify({'success': False, 'message': f'{med["name"]} is out of stock'}), 409
+    
+    # Only unexpired lots can be sold: report their total and the earliest expiry among them
+    today = datetime.today().strftime('%Y-%m-%d')
+    sellable = [(expiry_date, quantity) for expiry_date, quantity in med['lots'] if not expiry_date or expiry_date >= today]
+    if not sellable:
+        return jsonify({'success': False, 'message': f'{med["name"]} has expired'}), 409
+    
+    medicine = {key: value for key, value in med.items() if key != 'lots'}
+    medicine['quantity'] = sum(quantity for _, quantity in sellable)
+    medicine['expiry_date'] = min((expiry_date for expiry_date, _ in sellable if expiry_date), default=None)
+    return jsonify({'success': True, 'medicine': medicine})
 
 # === Sales Reports ===
 
 @app.route('/sales_report')
 @login_required
 def sales_report():
-    start_date = request.args.get('start_date', datetime.today().replace(day=1).strftime('%Y-%m-%d'))
-    end_date = request.args.get('end_date', datetime.today().strftime('%Y-%m-%d'))
+    start_date, end_date, bounds = report_date_range()
     
     sales = query_db('''
         SELECT s.*, m.name as medicine_name, c.name as customer_name, a.full_name as cashier_name
@@ -485,13 +1798,16 @@ def sales_report():
         JOIN medicine m ON s.medicine_id = m.id
         LEFT JOIN customers c ON s.customer_id = c.id
         LEFT JOIN admin a ON s.cashier_id = a.id
-        WHERE DATE(s.sale_date) BETWEEN ? AND ?
+        WHERE s.sale_date >= ? AND s.sale_date < ?
         ORDER BY s.sale_date DESC
-    ''', (start_date, end_date))
+    ''', bounds)
     
-    # Calculate totals
-    total_sales = sum(sale['total_price'] for sale in sales)
-    total_items = sum(sale['quantity'] for sale in sales)
+    # Totals come straight from the invoice headers
+    totals = query_db('''SELECT COALESCE(SUM(total), 0) as total_sales, COALESCE(SUM(item_count), 0) as total_items
+                         FROM invoices
+                         WHERE sale_date >= ? AND sale_date < ?''', bounds, one=True)
+    total_sales = totals['total_sales']
+    total_items = totals['total_items']
     
     return render_template('sales_report.html', 
                          sales=sales, 
@@ -505,26 +1821,131 @@ def sales_report():
 @app.route('/low_stock')
 @login_required
 def low_stock():
+    # Walks the low-stock partial index in quantity order; supplier and batches are
+    # looked up by key for just those medicines
+    today = datetime.today().strftime('%Y-%m-%d')
     low_stock_meds = query_db('''
-        SELECT m.*, s.name as supplier_name 
+        SELECT m.*, s.name as supplier_name,
+               (SELECT COUNT(*) FROM medicine_batches WHERE medicine_id = m.id AND quantity > 0) as batch_count,
+               (SELECT MIN(expiry_date) FROM medicine_batches WHERE medicine_id = m.id AND quantity > 0) as next_expiry,
+               (SELECT COALESCE(SUM(quantity), 0) FROM medicine_batches
+                WHERE medicine_id = m.id AND quantity > 0 AND expiry_date < ?) as expired_quantity
         FROM medicine m
         LEFT JOIN suppliers s ON m.supplier_id = s.id
-        WHERE m.quantity < m.reorder_level
+        WHERE m.is_low_stock
         ORDER BY m.quantity ASC
-    ''')
+    ''', (today,))
     return render_template('low_stock.html', medicines=low_stock_meds)
 
 @app.route('/expired')
 @login_required
 def expired_medicines():
-    today = datetime.today().strftime('%Y-%m-%d')
-    expired = query_db("SELECT * FROM medicine WHERE expiry_date < ? ORDER BY expiry_date", (today,))
+    # One row per batch flagged by the last scan that still holds stock
+    batches = '''SELECT b.id as batch_id, b.batch_number, b.quantity, b.expiry_date, m.id, m.name,
+                         b.quantity * COALESCE(b.cost_price, m.cost_price, 0) as cost_value
+                  FROM stock_alerts a
+                  JOIN medicine_batches b ON b.id = a.batch_id
+                  JOIN medicine m ON m.id = b.medicine_id
+                  WHERE a.kind = ? AND b.quantity > 0
+                  ORDER BY b.expiry_date'''
+    expired = query_db(batches, ('expired',))
+    expiring_soon = query_db(batches, ('expiring',))
     
-    thirty_days = (datetime.today() + timedelta(days=30)).strftime('%Y-%m-%d')
-    expiring_soon = query_db("SELECT * FROM medicine WHERE expiry_date BETWEEN ? AND ? ORDER BY expiry_date", 
-                            (today, thirty_days))
+    return render_template('expired.html', expired=expired, expiring_soon=expiring_soon,
+                           lookahead_days=app.config['EXPIRY_LOOKAHEAD_DAYS'], last_scan=last_stock_scan())
+
+def last_stock_scan():
+    """When the stock alerts were last rebuilt (None before the first scan)"""
+    row = query_db("SELECT last_run_at FROM task_runs WHERE name = 'stock_alerts'", one=True)
+    return row['last_run_at'] if row else None
+
+@app.route('/stock_alerts/scan', methods=['POST'])
+@login_required
+def rescan_stock_alerts():
+    counts = scan_stock_alerts(get_db())
+    log_activity('Stock Scan', f"Rescanned stock alerts: {sum(counts.values())} alerts")
+    flash('Stock alerts rescanned.', 'success')
+    return redirect(request.referrer or url_for('expired_medicines'))
+
+# Expired batches still holding stock (all, or those in the :batch_ids JSON list)
+EXPIRED_WRITE_OFF_BATCHES = '''b.quantity > 0 AND b.expiry_date < :today
+                               AND (:batch_ids IS NULL OR b.id IN (SELECT value FROM json_each(:batch_ids)))'''
+
+def write_off_expired(conn, batch_ids=None, adjusted_by=None):
+    """Remove expired batches from stock in one transaction.
     
-    return render_template('expired.html', expired=expired, expiring_soon=expiring_soon)
+    Each batch gets an 'expired' subtract adjustment carrying its cost value, then
+    the batch row is deleted (the ledger records the stock leaving). batch_ids
+    limits the write-off to those batches; batches that are not expired are
+    ignored. Returns a summary dict.
+    """
+    params = {'today': datetime.today().strftime('%Y-%m-%d'), 'adjusted_by': adjusted_by,
+              'batch_ids': None if batch_ids is None else json.dumps(list(batch_ids))}
+    with write_transaction(conn):
+        batches = conn.execute(f'''SELECT b.id, b.medicine_id, b.quantity,
+                                          b.quantity * COALESCE(b.cost_price, m.cost_price, 0) as cost_value
+                                   FROM medicine_batches b
+                                   JOIN medicine m ON m.id = b.medicine_id
+                                   WHERE {EXPIRED_WRITE_OFF_BATCHES}''', params).fetchall()
+        conn.execute(f'''INSERT INTO inventory_adjustments 
+                         (medicine_id, adjustment_type, quantity_change, reason, adjusted_by, cost_value)
+                         SELECT b.medicine_id, 'subtract', b.quantity, 'expired', :adjusted_by,
+                                b.quantity * COALESCE(b.cost_price, m.cost_price, 0)
+                         FROM medicine_batches b
+                         JOIN medicine m ON m.id = b.medicine_id
+                         WHERE {EXPIRED_WRITE_OFF_BATCHES}''', params)
+        written_off = json.dumps([batch['id'] for batch in batches])
+        conn.execute("DELETE FROM medicine_batches WHERE id IN (SELECT value FROM json_each(?))", (written_off,))
+        conn.execute('''DELETE FROM stock_alerts WHERE kind = 'expired'
+                        AND batch_id IN (SELECT value FROM json_each(?))''', (written_off,))
+    
+    return {'batches': len(batches),
+            'medicine_ids': sorted({batch['medicine_id'] for batch in batches}),
+            'units': sum(batch['quantity'] for batch in batches),
+            'cost_value': round(sum(batch['cost_value'] for batch in batches), 2)}
+
+@app.route('/expired/write_off', methods=['POST'])
+@login_required
+def write_off_expired_stock():
+    # Writing off everything must be asked for explicitly: all=1 on the form, "all": true in JSON
+    if request.is_json:
+        data = request.get_json(silent=True)
+        data = data if isinstance(data, dict) else {}
+        if data.get('all') is True:
+            batch_ids = None
+        else:
+            batch_ids = data.get('batch_ids')
+            if not isinstance(batch_ids, list) or not all(type(batch_id) is int for batch_id in batch_ids):
+                return jsonify({'success': False,
+                                'message': 'Send "batch_ids" as a list of batch IDs, or "all": true'}), 400
+    elif request.form.get('all') == '1':
+        batch_ids = None
+    else:
+        try:
+            batch_ids = [int(batch_id) for batch_id in request.form.getlist('batch_ids')]
+        except ValueError:
+            flash('Invalid batch selection.', 'danger')
+            return redirect(url_for('expired_medicines'))
+    
+    if batch_ids == []:
+        summary = {'batches': 0, 'medicine_ids': [], 'units': 0, 'cost_value': 0}
+    else:
+        summary = write_off_expired(get_db(), batch_ids, session['admin_id'])
+    
+    if summary['batches']:
+        invalidate_barcode_index(summary['medicine_ids'])
+        invalidate_cache('stock')
+        log_activity('Expired Write-off', f"Wrote off {summary['units']} units from {summary['batches']} expired "
+                                          f"batches (cost {summary['cost_value']:.2f})")
+    
+    if request.is_json:
+        return jsonify({'success': True, **summary})
+    if summary['batches']:
+        flash(f"Wrote off {summary['units']} units from {summary['batches']} expired batches "
+              f"(cost ₨ {summary['cost_value']:.2f}).", 'success')
+    else:
+        flash('No expired stock was selected.', 'warning')
+    return redirect(url_for('expired_medicines'))
 
 @app.route('/inventory_adjustment', methods=['GET', 'POST'])
 @login_required
@@ -535,18 +1956,29 @@ def inventory_adjustment():
         quantity_change = int(request.form['quantity_change'])
         reason = request.form['reason']
         
-        # Update medicine quantity
-        if adjustment_type == 'add':
-            query_db("UPDATE medicine SET quantity = quantity + ? WHERE id = ?", (quantity_change, medicine_id))
-        else:
-            query_db("UPDATE medicine SET quantity = quantity - ? WHERE id = ?", (quantity_change, medicine_id))
-        
-        # Log adjustment
-        query_db('''INSERT INTO inventory_adjustments 
-                    (medicine_id, adjustment_type, quantity_change, reason, adjusted_by)
-                    VALUES (?, ?, ?, ?, ?)''',
-                (medicine_id, adjustment_type, quantity_change, reason, session['admin_id']))
+        conn = get_db()
+        with write_transaction(conn):
+            # Added stock goes into the given lot (default: the last one received); removals are taken FEFO
+            if adjustment_type == 'add':
+                if request.form.get('batch_number') or request.form.get('expiry_date'):
+                    cost_price = conn.execute("SELECT cost_price FROM medicine WHERE id=?", (medicine_id,)).fetchone()[0]
+                    receive_stock(conn, medicine_id, quantity_change, request.form.get('batch_number'),
+                                  request.form.get('expiry_date'), cost_price)
+                else:
+                    conn.execute(BATCH_RECEIVE_LATEST_LOT, (quantity_change, medicine_id))
+            elif allocate_fefo(conn, {int(medicine_id): quantity_change}, include_expired=True):
+                conn.rollback()
+                flash('Cannot subtract more than the current stock.', 'danger')
+                return redirect(url_for('inventory_adjustment'))
+            
+            # Log adjustment
+            conn.execute('''INSERT INTO inventory_adjustments 
+                            (medicine_id, adjustment_type, quantity_change, reason, adjusted_by)
+                            VALUES (?, ?, ?, ?, ?)''',
+                         (medicine_id, adjustment_type, quantity_change, reason, session['admin_id']))
         
+        invalidate_barcode_index([int(medicine_id)])
+        invalidate_cache('stock')
         log_activity('Inventory Adjustment', f"Medicine ID: {medicine_id}, Type: {adjustment_type}, Qty: {quantity_change}")
         flash('Inventory adjusted successfully!', 'success')
         return redirect(url_for('medicines'))
@@ -554,13 +1986,243 @@ def inventory_adjustment():
     medicines = query_db("SELECT * FROM medicine ORDER BY name")
     return render_template('inventory_adjustment.html', medicines=medicines)
 
+# === Stock Take ===
+# A physical count is posted as one file or JSON array. Counts land in a temp table,
+# variances against current stock are computed in SQL, and every adjustment and
+# stock change is written in a single transaction.
+
+STOCK_TAKE_VARIANCES = '''
+    SELECT m.id as medicine_id, m.name, m.barcode, m.quantity as expected, c.counted,
+           c.counted - m.quantity as variance,
+           (c.counted - m.quantity) * COALESCE(m.cost_price, 0) as variance_value
+    FROM (SELECT medicine_id, SUM(counted) as counted FROM temp.stock_take_counts GROUP BY medicine_id) c
+    JOIN medicine m ON m.id = c.medicine_id
+'''
+
+def parse_stock_counts(entries, first_line=1):
+    """Read {'medicine_id' or 'barcode', 'counted_quantity'} entries into (counts, errors)"""
+    counts, errors = [], []
+    for line, entry in enumerate(entries, start=first_line):
+        if not isinstance(entry, dict):
+            errors.append((line, "Each count must be an object with medicine_id or barcode, and counted_quantity"))
+            continue
+        
+        def field(name):
+            value = entry.get(name)
+            return '' if value is None else str(value).strip()
+        
+        medicine_id, barcode, counted = field('medicine_id'), field('barcode'), field('counted_quantity')
+        if not (medicine_id or barcode) or not counted:
+            errors.append((line, "Needs medicine_id or barcode, and counted_quantity"))
+            continue
+        try:
+            counted = int(counted)
+            medicine_id = int(medicine_id) if medicine_id else None
+        except ValueError:
+            errors.append((line, "medicine_id and counted_quantity must be whole numbers"))
+            continue
+        if counted < 0:
+            errors.append((line, "counted_quantity cannot be negative"))
+            continue
+        counts.append((line, medicine_id, barcode or None, counted))
+    return counts, errors
+
+def apply_stock_take(conn, counts, reason, adjusted_by, preview=False):
+    """Reconcile counted quantities with stock in one transaction and summarise the variances.
+    
+    Medicines counted more than once (e.g. on two shelves) have their counts summed.
+    With preview=True the variances are computed but nothing is written.
+    """
+    with write_transaction(conn):
+        conn.execute('''CREATE TEMP TABLE IF NOT EXISTS stock_take_counts (
+            line INTEGER, medicine_id INTEGER, barcode TEXT, counted INTEGER NOT NULL
+        )''')
+        conn.execute("DELETE FROM temp.stock_take_counts")
+        conn.executemany("INSERT INTO temp.stock_take_counts VALUES (?, ?, ?, ?)", counts)
+        conn.execute('''UPDATE temp.stock_take_counts
+                        SET medicine_id = (SELECT id FROM medicine WHERE barcode = stock_take_counts.barcode)
+                        WHERE medicine_id IS NULL''')
+        unmatched = conn.execute('''SELECT line, COALESCE(barcode, medicine_id) as reference
+                                    FROM temp.stock_take_counts t
+                                    WHERE NOT EXISTS (SELECT 1 FROM medicine WHERE id = t.medicine_id)
+                                    ORDER BY line''').fetchall()
+        variances = conn.execute(f"{STOCK_TAKE_VARIANCES} ORDER BY ABS(variance) DESC, m.name").fetchall()
+        changed = [row for row in variances if row['variance']]
+        
+        if not preview:
+            conn.executemany('''INSERT INTO inventory_adjustments 
+                                (medicine_id, adjustment_type, quantity_change, reason, adjusted_by)
+                                VALUES (?, ?, ?, ?, ?)''',
+                             [(row['medicine_id'], 'add' if row['variance'] > 0 else 'subtract',
+                               abs(row['variance']), reason, adjusted_by) for row in changed])
+            # Found stock goes into each medicine's latest lot; missing stock comes off FEFO
+            conn.executemany(BATCH_RECEIVE_LATEST_LOT,
+                             [(row['variance'], row['medicine_id']) for row in changed if row['variance'] > 0])
+            allocate_fefo(conn, {row['medicine_id']: -row['variance'] for row in changed if row['variance'] < 0},
+                          include_expired=True)
+        
+        conn.execute("DELETE FROM temp.stock_take_counts")
+        if preview:
+            conn.rollback()
+    
+    return {
+        'applied': not preview,
+        'counted': len(variances),
+        'matching': len(variances) - len(changed),
+        'adjusted': len(changed),
+        'units_over': sum(row['variance'] for row in changed if row['variance'] > 0),
+        'units_short': -sum(row['variance'] for row in changed if row['variance'] < 0),
+        'value_over': round(sum(row['variance_value'] for row in changed if row['variance'] > 0), 2),
+        'value_short': round(-sum(row['variance_value'] for row in changed if row['variance'] < 0), 2),
+        'unmatched': [dict(row) for row in unmatched],
+        'variances': [dict(row) for row in changed],
+    }
+
+@app.route('/stock_take', methods=['GET', 'POST'])
+@login_required
+def stock_take():
+    if request.method == 'GET':
+        return render_template('stock_take.html', summary=None)
+    
+    # JSON: a list of counts, or {"counts": [...], "reason": ..., "preview": ...}
+    if request.is_json:
+        data = request.get_json()
+        if isinstance(data, list):
+            data = {'counts': data}
+        if not isinstance(data, dict) or not isinstance(data.get('counts'), list):
+            return jsonify({'success': False, 'message': 'Expected a list of counts'}), 400
+        counts, errors = parse_stock_counts(data['counts'], first_line=0)
+        reason = data.get('reason') or 'Stock take'
+        preview = bool(data.get('preview'))
+    else:
+        file = request.files.get('file')
+        if not file or not file.filename.endswith('.csv'):
+            flash('Please upload the counts as a CSV file!', 'danger')
+            return redirect(request.url)
+        try:
+            reader = csv.DictReader(codecs.iterdecode(file.stream, 'utf-8-sig'))
+            counts, errors = parse_stock_counts(reader, first_line=2)  # Row 1 is the header
+        except (UnicodeDecodeError, csv.Error) as e:
+            flash(f'Error reading CSV file: {str(e)}', 'danger')
+            return redirect(request.url)
+        reason = request.form.get('reason') or 'Stock take'
+        preview = request.form.get('preview') == '1'
+    
+    summary = apply_stock_take(get_db(), counts, reason, session['admin_id'], preview)
+    summary['errors'] = [{'line': line, 'message': message} for line, message in errors]
+    
+    if summary['applied'] and summary['adjusted']:
+        invalidate_barcode_index([row['medicine_id'] for row in summary['variances']])
+        invalidate_cache('stock')
+        log_activity('Stock Take', f"Counted {summary['counted']} medicines, adjusted {summary['adjusted']} "
+                                   f"(+{summary['units_over']} / -{summary['units_short']} units)")
+    
+    if request.is_json:
+        return jsonify({'success': True, **summary})
+    return render_template('stock_take.html', summary=summary)
+
+# === Stock Valuation ===
+
+@app.route('/stock_valuation')
+@login_required
+def stock_valuation():
+    """Stock held on a past date (at close of day), rebuilt from the stock ledger"""
+    on_date = request.args.get('date') or datetime.today().strftime('%Y-%m-%d')
+    try:
+        _, at = date_range_bounds(on_date)
+    except ValueError:
+        flash('Invalid date, showing today instead.', 'warning')
+        on_date = datetime.today().strftime('%Y-%m-%d')
+        _, at = date_range_bounds(on_date)
+    
+    medicine_id = request.args.get('medicine_id', type=int)
+    rows = [row for row in stock_at(get_db(), at, medicine_id) if row['quantity'] or medicine_id]
+    
+    if request.args.get('format') == 'json':
+        return jsonify({'date': on_date, 'medicines': [dict(row) for row in rows],
+                        'total_value': round(sum(row['value'] for row in rows), 2)})
+    return render_template('stock_valuation.html', rows=rows, on_date=on_date, medicine_id=medicine_id,
+                           total_quantity=sum(row['quantity'] for row in rows),
+                           total_value=sum(row['value'] for row in rows))
+
+# === Stock Reconciliation ===
+
+# Expected stock per medicine in one grouped pass over each source: the opening balance
+# from when the ledger was added, plus adjustments, minus sales recorded since then
+STOCK_RECONCILIATION = '''
+    WITH since (at) AS (SELECT COALESCE(MIN(taken_at), '') FROM stock_snapshots WHERE last_movement_id = 0),
+    opening AS (SELECT medicine_id, quantity FROM stock_snapshots WHERE last_movement_id = 0),
+    sold AS (
+        SELECT medicine_id, SUM(quantity) as quantity FROM sales
+        WHERE sale_date >= (SELECT at FROM since)
+        GROUP BY medicine_id
+    ),
+    adjusted AS (
+        SELECT medicine_id,
+               SUM(CASE WHEN adjustment_type = 'subtract' THEN -quantity_change ELSE quantity_change END) as quantity
+        FROM inventory_adjustments
+        WHERE adjustment_date >= (SELECT at FROM since)
+        GROUP BY medicine_id
+    ),
+    expected AS (
+        SELECT m.id as medicine_id, m.name, m.barcode, m.quantity as actual,
+               COALESCE(o.quantity, 0) + COALESCE(a.quantity, 0) - COALESCE(s.quantity, 0) as expected
+        FROM medicine m
+        LEFT JOIN opening o ON o.medicine_id = m.id
+        LEFT JOIN adjusted a ON a.medicine_id = m.id
+        LEFT JOIN sold s ON s.medicine_id = m.id
+    )
+    SELECT *, actual - expected as difference
+    FROM expected
+    WHERE actual != expected
+    ORDER BY ABS(actual - expected) DESC, name
+'''
+
+RECONCILIATION_REASON = 'Reconciliation: unrecorded stock change'
+
+def reconcile_stock(conn, apply=False, adjusted_by=None):
+    """Return medicines whose stock differs from what sales and adjustments imply.
+    
+    With apply=True the differences are recorded as adjustments in the same
+    transaction, so the history accounts for the stock actually held. Stock
+    itself is not changed: a physical count belongs in a stock take.
+    """
+    if not apply:
+        # A plain read: the till must not wait behind the grouped scan
+        return conn.execute(STOCK_RECONCILIATION).fetchall()
+    
+    with write_transaction(conn):
+        mismatches = conn.execute(STOCK_RECONCILIATION).fetchall()
+        conn.executemany('''INSERT INTO inventory_adjustments 
+                            (medicine_id, adjustment_type, quantity_change, reason, adjusted_by)
+                            VALUES (?, ?, ?, ?, ?)''',
+                         [(row['medicine_id'], 'add' if row['difference'] > 0 else 'subtract',
+                           abs(row['difference']), RECONCILIATION_REASON, adjusted_by) for row in mismatches])
+    return mismatches
+
+@app.route('/reconciliation', methods=['GET', 'POST'])
+@login_required
+def reconciliation():
+    if request.method == 'POST':
+        if session.get('role') != 'admin':
+            flash('Only admins can record corrective adjustments.', 'danger')
+            return redirect(url_for('reconciliation'))
+        
+        mismatches = reconcile_stock(get_db(), apply=True, adjusted_by=session['admin_id'])
+        log_activity('Stock Reconciliation', f"Recorded corrective adjustments for {len(mismatches)} medicines")
+        flash(f'Recorded corrective adjustments for {len(mismatches)} medicines.', 'success')
+        return redirect(url_for('reconciliation'))
+    
+    mismatches = reconcile_stock(get_db())
+    return render_template('reconciliation.html', mismatches=mismatches)
+
 # === Customer Management ===
 
 @app.route('/customers')
 @login_required
 def customers():
-    customers = query_db("SELECT * FROM customers ORDER BY name")
-    return render_template('customers.html', customers=customers)
+    customers, pagination = keyset_page("SELECT * FROM customers WHERE 1=1", [], 'name')
+    return render_template('customers.html', customers=customers, pagination=pagination)
 
 @app.route('/add_customer', methods=['GET', 'POST'])
 @login_required
@@ -572,6 +2234,7 @@ def add_customer():
                  request.form.get('address'), request.form.get('date_of_birth'),
                  request.form.get('medical_history'), request.form.get('allergies')))
         
+        invalidate_cache('customers')
         log_activity('Add Customer', f"Added customer: {request.form['name']}")
         flash(f"Customer '{request.form['name']}' added successfully!", 'success')
         return redirect(url_for('customers'))
@@ -589,6 +2252,7 @@ def edit_customer(customer_id):
                  request.form.get('address'), request.form.get('date_of_birth'),
                  request.form.get('medical_history'), request.form.get('allergies'), customer_id))
         
+        invalidate_cache('customers')
         log_activity('Edit Customer', f"Updated customer ID: {customer_id}")
         flash('Customer updated successfully!', 'success')
         return redirect(url_for('customers'))
@@ -601,8 +2265,8 @@ def edit_customer(customer_id):
 @app.route('/suppliers')
 @login_required
 def suppliers():
-    suppliers = query_db("SELECT * FROM suppliers ORDER BY name")
-    return render_template('suppliers.html', suppliers=suppliers)
+    suppliers, pagination = keyset_page("SELECT * FROM suppliers WHERE 1=1", [], 'name')
+    return render_template('suppliers.html', suppliers=suppliers, pagination=pagination)
 
 @app.route('/add_supplier', methods=['GET', 'POST'])
 @login_required
@@ -613,6 +2277,7 @@ def add_supplier():
                 (request.form['name'], request.form.get('contact_person'),
                  request.form.get('phone'), request.form.get('email'), request.form.get('address')))
         
+        invalidate_cache('suppliers')
         log_activity('Add Supplier', f"Added supplier: {request.form['name']}")
         flash(f"Supplier '{request.form['name']}' added successfully!", 'success')
         return redirect(url_for('suppliers'))
@@ -624,14 +2289,14 @@ def add_supplier():
 @app.route('/purchase_orders')
 @login_required
 def purchase_orders():
-    pos = query_db('''
+    pos, pagination = keyset_page('''
         SELECT po.*, s.name as supplier_name, a.full_name as created_by_name
         FROM purchase_orders po
         JOIN suppliers s ON po.supplier_id = s.id
         LEFT JOIN admin a ON po.created_by = a.id
-        ORDER BY po.order_date DESC
-    ''')
-    return render_template('purchase_orders.html', purchase_orders=pos)
+        WHERE 1=1
+    ''', [], 'po.order_date', descending=True, id_column='po.id')
+    return render_template('purchase_orders.html', purchase_orders=pos, pagination=pagination)
 
 @app.route('/create_po', methods=['GET', 'POST'])
 @login_required
@@ -662,17 +2327,15 @@ def create_po():
                          (po_id, item['medicine_id'], item['quantity'], item['unit_price']))
             
             conn.commit()
-            conn.close()
             
             log_activity('Create PO', f"PO Number: {po_number}")
             return jsonify({'success': True, 'po_number': po_number})
             
         except Exception as e:
             conn.rollback()
-            conn.close()
             return jsonify({'success': False, 'message': str(e)}), 500
     
-    suppliers = query_db("SELECT * FROM suppliers ORDER BY name")
+    suppliers = cached_query("SELECT * FROM suppliers ORDER BY name", tags=('suppliers',), ttl=300)
     medicines = query_db("SELECT * FROM medicine ORDER BY name")
     return render_template('create_po.html', suppliers=suppliers, medicines=medicines)
 
@@ -703,11 +2366,10 @@ def analytics():
     
     # Daily sales trend (last 30 days)
     daily_sales = query_db('''
-        SELECT DATE(sale_date) as date, SUM(total_price) as total
-        FROM sales
-        WHERE sale_date >= date('now', '-30 days')
-        GROUP BY DATE(sale_date)
-        ORDER BY date
+        SELECT sale_day as date, revenue as total
+        FROM daily_sales_summary
+        WHERE sale_day >= date('now', '-30 days')
+        ORDER BY sale_day
     ''')
     
     return render_template('analytics.html',
@@ -716,59 +2378,476 @@ def analytics():
                          daily_sales=daily_sales)
 
 # === Export Functions ===
+# Exports stream straight from a cursor in EXPORT_BATCH_SIZE batches, so memory
+# use stays flat and the first bytes go out before the query has finished.
+EXPORT_BATCH_SIZE = 1000
 
-@app.route('/export_inventory')
-@login_required
-def export_inventory():
-    medicines = query_db("SELECT * FROM medicine")
+INVENTORY_EXPORT_HEADER = ['ID', 'Name', 'Generic Name', 'Brand', 'Category', 'Quantity', 
+                           'Reorder Level', 'Cost Price', 'Selling Price', 'Expiry Date', 
+                           'Barcode', 'Batch Number', 'Rack Location']
+
+SALES_EXPORT_HEADER = ['Invoice', 'Medicine', 'Customer', 'Quantity', 'Unit Price', 
+                       'Discount', 'Tax', 'Total', 'Payment Method', 'Date']
+
+def inventory_export_cursor(conn):
+    return conn.execute("SELECT * FROM medicine ORDER BY id")
+
+def inventory_export_row(med):
+    return [med['id'], med['name'], med['generic_name'], med['brand'], 
+            med['category'], med['quantity'], med['reorder_level'],
+            med['cost_price'], med['price'], med['expiry_date'],
+            med['barcode'], med['batch_number'], med['rack_location']]
+
+def sales_export_cursor(conn, bounds):
+    return conn.execute('''
+        SELECT s.*, m.name as medicine_name, c.name as customer_name
+        FROM sales s
+        JOIN medicine m ON s.medicine_id = m.id
+        LEFT JOIN customers c ON s.customer_id = c.id
+        WHERE s.sale_date >= ? AND s.sale_date < ?
+        ORDER BY s.sale_date DESC
+    ''', bounds)
+
+def sales_export_row(sale):
+    return [sale['invoice_number'], sale['medicine_name'], 
+            sale['customer_name'] or 'Walk-in', sale['quantity'],
+            sale['unit_price'], sale['discount'], sale['tax'],
+            sale['total_price'], sale['payment_method'], sale['sale_date']]
+
+def iter_csv(cursor, header, row_builder, compress=False):
+    """Yield the CSV encoding of `cursor` chunk by chunk, gzip-compressed if requested"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    compressor = zlib.compressobj(wbits=31) if compress else None  # wbits=31 writes a gzip header
     
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(['ID', 'Name', 'Generic Name', 'Brand', 'Category', 'Quantity', 
-                    'Reorder Level', 'Cost Price', 'Selling Price', 'Expiry Date', 
-                    'Barcode', 'Batch Number', 'Rack Location'])
+    def drain():
+        data = buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+        return compressor.compress(data) if compressor else data
     
-    for med in medicines:
-        writer.writerow([med['id'], med['name'], med['generic_name'], med['brand'], 
-                        med['category'], med['quantity'], med['reorder_level'],
-                        med['cost_price'], med['price'], med['expiry_date'],
-                        med['barcode'], med['batch_number'], med['rack_location']])
+    writer.writerow(header)
+    yield drain()
     
-    output.seek(0)
-    return Response(output, mimetype='text/csv',
-                   headers={'Content-Disposition': 'attachment;filename=inventory_export.csv'})
+    while True:
+        rows = cursor.fetchmany(EXPORT_BATCH_SIZE)
+        if not rows:
+            break
+        writer.writerows(row_builder(row) for row in rows)
+        chunk = drain()
+        if chunk:
+            yield chunk
+    
+    if compressor:
+        yield compressor.flush()
+
+def csv_download(chunks, filename, compress=False):
+    if compress:
+        return Response(stream_with_context(chunks), mimetype='application/gzip',
+                        headers={'Content-Disposition': f'attachment;filename={filename}.gz'})
+    return Response(stream_with_context(chunks), mimetype='text/csv',
+                    headers={'Content-Disposition': f'attachment;filename={filename}'})
+
+@app.route('/export_inventory')
+@login_required
+def export_inventory():
+    compress = request.args.get('gzip') == '1'
+    chunks = iter_csv(inventory_export_cursor(get_db()), INVENTORY_EXPORT_HEADER, inventory_export_row, compress)
+    return csv_download(chunks, 'inventory_export.csv', compress)
 
 @app.route('/export_sales')
 @login_required
 def export_sales():
-    start_date = request.args.get('start_date', datetime.today().replace(day=1).strftime('%Y-%m-%d'))
-    end_date = request.args.get('end_date', datetime.today().strftime('%Y-%m-%d'))
+    start_date, end_date, bounds = report_date_range()
+    compress = request.args.get('gzip') == '1'
+    chunks = iter_csv(sales_export_cursor(get_db(), bounds), SALES_EXPORT_HEADER, sales_export_row, compress)
+    return csv_download(chunks, f'sales_report_{start_date}_to_{end_date}.csv', compress)
+
+# === Background Export Jobs ===
+# Large exports run on a small thread pool and are written to EXPORT_FOLDER, so the
+# request that asks for one returns at once. The jobs table tracks status and progress.
+# Without BACKGROUND_EXPORTS (serverless) a requested export is streamed straight back.
+EXPORT_JOB_WORKERS = 2
+EXPORT_RETENTION_HOURS = 24
+
+export_executor = ThreadPoolExecutor(max_workers=EXPORT_JOB_WORKERS, thread_name_prefix='export-job')
+atexit.register(export_executor.shutdown, wait=False)
+
+def update_job(conn, job_id, **fields):
+    assignments = ', '.join(f"{column}=?" for column in fields)
+    conn.execute(f"UPDATE jobs SET {assignments} WHERE id=?", (*fields.values(), job_id))
+    conn.commit()
+
+def run_export_job(job_id):
+    """Write one export job's CSV to EXPORT_FOLDER, recording progress per batch"""
+    conn = connect_db()          # reads the export
+    status_conn = connect_db()   # progress updates, committed while the export cursor is open
+    part_path = None
+    try:
+        purge_expired_exports(status_conn)
+        job = conn.execute("SELECT * FROM jobs WHERE id=?", (job_id,)).fetchone()
+        params = json.loads(job['params'] or '{}')
+        compress = params.get('gzip', False)
+        
+        if job['kind'] == 'sales':
+            bounds = date_range_bounds(params['start_date'], params['end_date'])
+            total = conn.execute("SELECT COUNT(*) FROM sales WHERE sale_date >= ? AND sale_date < ?", bounds).fetchone()[0]
+            cursor = sales_export_cursor(conn, bounds)
+            header, row_builder = SALES_EXPORT_HEADER, sales_export_row
+        else:
+            total = conn.execute("SELECT COUNT(*) FROM medicine").fetchone()[0]
+            cursor = inventory_export_cursor(conn)
+            header, row_builder = INVENTORY_EXPORT_HEADER, inventory_export_row
+        update_job(status_conn, job_id, status='running', total=total)
+        
+        written = 0
+        def counted_row(row):
+            nonlocal written
+            written += 1
+            return row_builder(row)
+        
+        file_path = os.path.join(app.config['EXPORT_FOLDER'], f"job_{job_id}.csv" + ('.gz' if compress else ''))
+        part_path = file_path + '.part'
+        with open(part_path, 'wb') as f:
+            for chunk in iter_csv(cursor, header, counted_row, compress):
+                f.write(chunk)
+                if written:
+                    update_job(status_conn, job_id, progress=written)
+        os.replace(part_path, file_path)
+        
+        finished_at = datetime.now()
+        update_job(status_conn, job_id, status='done', progress=written, file_path=file_path,
+                   finished_at=finished_at.strftime('%Y-%m-%d %H:%M:%S'),
+                   expires_at=(finished_at + timedelta(hours=EXPORT_RETENTION_HOURS)).strftime('%Y-%m-%d %H:%M:%S'))
+    except Exception as e:
+        app.logger.exception("Export job %s failed", job_id)
+        if part_path and os.path.exists(part_path):
+            os.remove(part_path)
+        finished_at = datetime.now()
+        update_job(status_conn, job_id, status='failed', error=str(e),
+                   finished_at=finished_at.strftime('%Y-%m-%d %H:%M:%S'),
+                   expires_at=(finished_at + timedelta(hours=EXPORT_RETENTION_HOURS)).strftime('%Y-%m-%d %H:%M:%S'))
+    finally:
+        conn.close()
+        status_conn.close()
+
+def submit_export_job(kind, params, file_name):
+    """Record a queued export job and hand it to the pool; returns the job id"""
+    c = get_db().execute('''INSERT INTO jobs (kind, params, file_name, created_by, created_at)
+                            VALUES (?, ?, ?, ?, ?)''',
+                         (kind, json.dumps(params), file_name, session['admin_id'],
+                          datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+    get_db().commit()
+    export_executor.submit(run_export_job, c.lastrowid)
+    return c.lastrowid
+
+def purge_expired_exports(conn):
+    """Delete expired export jobs and their files; returns the number of jobs removed"""
+    now = datetime.now()
+    # Jobs that never finished (e.g. the process restarted mid-export) expire from creation
+    stale_before = now - timedelta(hours=EXPORT_RETENTION_HOURS)
+    expired = conn.execute('''SELECT id, file_path FROM jobs
+                              WHERE expires_at < ? OR (expires_at IS NULL AND created_at < ?)''',
+                           (now.strftime('%Y-%m-%d %H:%M:%S'), stale_before.strftime('%Y-%m-%d %H:%M:%S'))).fetchall()
+    for job in expired:
+        if job['file_path'] and os.path.exists(job['file_path']):
+            os.remove(job['file_path'])
+    conn.executemany("DELETE FROM jobs WHERE id=?", [(job['id'],) for job in expired])
+    conn.commit()
+    return len(expired)
+
+def job_status(job):
+    return {
+        'id': job['id'],
+        'kind': job['kind'],
+        'status': job['status'],
+        'progress': job['progress'],
+        'total': job['total'],
+        'error': job['error'],
+        'created_at': job['created_at'],
+        'expires_at': job['expires_at'],
+        'download_url': url_for('download_export_job', job_id=job['id']) if job['status'] == 'done' else None,
+    }
+
+@app.route('/export_jobs', methods=['GET', 'POST'])
+@login_required
+def export_jobs():
+    if request.method == 'POST':
+        kind = request.form.get('kind')
+        compress = request.form.get('gzip') == '1'
+        if kind == 'sales':
+            start_date, end_date, _ = report_date_range()
+            params = {'start_date': start_date, 'end_date': end_date, 'gzip': compress}
+            file_name = f'sales_report_{start_date}_to_{end_date}.csv'
+        elif kind == 'inventory':
+            params = {'gzip': compress}
+            file_name = 'inventory_export.csv'
+        else:
+            flash('Unknown export type.', 'danger')
+            return redirect(url_for('export_jobs'))
+        
+        if not app.config.get('BACKGROUND_EXPORTS'):
+            if kind == 'sales':
+                return redirect(url_for('export_sales', start_date=start_date, end_date=end_date,
+                                        gzip='1' if compress else None))
+            return redirect(url_for('export_inventory', gzip='1' if compress else None))
+        
+        if compress:
+            file_name += '.gz'
+        job_id = submit_export_job(kind, params, file_name)
+        log_activity('Export Started', f"Export job #{job_id}: {file_name}")
+        flash(f'Export #{job_id} started. It will be ready to download here shortly.', 'info')
+        return redirect(url_for('export_jobs'))
     
-    sales = query_db('''
-        SELECT s.*, m.name as medicine_name, c.name as customer_name
-        FROM sales s
-        JOIN medicine m ON s.medicine_id = m.id
-        LEFT JOIN customers c ON s.customer_id = c.id
-        WHERE DATE(s.sale_date) BETWEEN ? AND ?
-        ORDER BY s.sale_date DESC
-    ''', (start_date, end_date))
+    jobs = query_db("SELECT * FROM jobs WHERE created_by=? ORDER BY created_at DESC, id DESC LIMIT 50",
+                    (session['admin_id'],))
+    return render_template('export_jobs.html', jobs=jobs)
+
+@app.route('/api/export_jobs/<int:job_id>')
+@login_required
+def export_job_status(job_id):
+    job = query_db("SELECT * FROM jobs WHERE id=? AND created_by=?", (job_id, session['admin_id']), one=True)
+    if not job:
+        return jsonify({'success': False, 'message': 'Export job not found'}), 404
+    return jsonify({'success': True, 'job': job_status(job)})
+
+@app.route('/export_jobs/<int:job_id>/download')
+@login_required
+def download_export_job(job_id):
+    job = query_db("SELECT * FROM jobs WHERE id=? AND created_by=?", (job_id, session['admin_id']), one=True)
+    if not job or job['status'] != 'done' or not os.path.exists(job['file_path']):
+        flash('That export is not available. It may have expired.', 'warning')
+        return redirect(url_for('export_jobs'))
+    mimetype = 'application/gzip' if job['file_name'].endswith('.gz') else 'text/csv'
+    return send_file(job['file_path'], mimetype=mimetype, as_attachment=True, download_name=job['file_name'])
+
+# === CSV Import Medicine ===
+# Uploads are decoded line by line and processed IMPORT_CHUNK_SIZE rows at a time:
+# each chunk is validated, checked against preloaded barcodes and names, then
+# inserted with one executemany in its own short transaction.
+IMPORT_CHUNK_SIZE = 5000
+
+MEDICINE_IMPORT_INSERT = f'''INSERT INTO medicine ({', '.join(IMPORT_COLUMNS)})
+                             VALUES ({', '.join('?' * len(IMPORT_COLUMNS))})'''
+
+# Files longer than one chunk can be validated in IMPORT_PROCESSES worker processes
+# while the request thread writes earlier chunks. The pool is started on first use
+# and kept for the life of the server.
+_import_pool = None
+_import_pool_lock = threading.Lock()
+
+# Merge mode: a row whose barcode already exists refreshes these fields of that medicine
+IMPORT_MERGE_COLUMNS = ['cost_price', 'price', 'expiry_date', 'batch_number']
+IMPORT_BARCODE = IMPORT_COLUMNS.index('barcode')
+IMPORT_QUANTITY = IMPORT_COLUMNS.index('quantity')
+IMPORT_COST_PRICE = IMPORT_COLUMNS.index('cost_price')
+IMPORT_EXPIRY_DATE = IMPORT_COLUMNS.index('expiry_date')
+IMPORT_BATCH_NUMBER = IMPORT_COLUMNS.index('batch_number')
+
+# A blank field in the CSV keeps the medicine's current value
+MEDICINE_IMPORT_UPSERT = (f"{MEDICINE_IMPORT_INSERT} ON CONFLICT(barcode) DO UPDATE SET "
+                          f"{', '.join(f'{column}=COALESCE(excluded.{column}, {column})' for column in IMPORT_MERGE_COLUMNS)}, "
+                          f"updated_at=CURRENT_TIMESTAMP")
+
+# Stock for merged rows goes to batches (the batch triggers update medicine.quantity):
+# added quantity is received into the row's lot, otherwise the row relabels the current lot
+IMPORT_BATCH_RECEIVE = '''INSERT INTO medicine_batches (medicine_id, batch_number, expiry_date, quantity, cost_price)
+                          SELECT id, ?, ?, ?, ? FROM medicine WHERE barcode = ?
+                          ON CONFLICT(medicine_id, COALESCE(batch_number, ''), COALESCE(expiry_date, ''))
+                          DO UPDATE SET quantity = quantity + excluded.quantity'''
+IMPORT_ADJUSTMENT = '''INSERT INTO inventory_adjustments (medicine_id, adjustment_type, quantity_change, reason)
+                       SELECT id, 'add', ?, 'CSV import' FROM medicine WHERE barcode = ?'''
+# Same batch as BATCH_TO_RELABEL; a relabel onto another existing lot fails on the lot index
+IMPORT_BATCH_RELABEL = '''UPDATE medicine_batches SET batch_number = ?, expiry_date = ?
+                          WHERE id = (SELECT b.id FROM medicine_batches b JOIN medicine m ON m.id = b.medicine_id
+                                      WHERE m.barcode = ? AND b.quantity > 0
+                                        AND (b.expiry_date IS NULL OR b.expiry_date >= date('now'))
+                                      ORDER BY b.expiry_date IS NULL, b.expiry_date, b.id LIMIT 1)'''
+
+def merge_changes(current, values, add_quantity=False):
+    """True if merging `values` into the existing medicine row `current` would change it"""
+    if add_quantity and values[IMPORT_QUANTITY]:
+        return True
+    return any(value is not None and current[column] != value
+               for column, value in ((column, values[IMPORT_COLUMNS.index(column)]) for column in IMPORT_MERGE_COLUMNS))
+
+def merged_labels(current, values):
+    """(batch_number, expiry_date) of a merged row, keeping the medicine's own where the CSV is blank"""
+    return (values[IMPORT_BATCH_NUMBER] or current['batch_number'],
+            values[IMPORT_EXPIRY_DATE] or current['expiry_date'])
+
+def iter_import_chunks(file, size=IMPORT_CHUNK_SIZE):
+    """Decode an uploaded CSV incrementally and yield lists of (row_num, row) pairs"""
+    reader = csv.DictReader(codecs.iterdecode(file.stream, 'utf-8-sig'))
+    chunk = []
+    for row_num, row in enumerate(reader, start=2):  # Start from 2 (header is row 1)
+        chunk.append((row_num, row))
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def import_pool():
+    """The shared import validation pool, or None to validate in the request thread"""
+    global _import_pool
+    processes = app.config['IMPORT_PROCESSES']
+    if processes <= 1 or getattr(sys, 'frozen', False):
+        # A frozen build would re-run the whole app in every worker
+        return None
+    with _import_pool_lock:
+        if _import_pool is None:
+            try:
+                # Spawned workers start clean instead of forking the threads of a running server
+                _import_pool = ProcessPoolExecutor(max_workers=processes,
+                                                   mp_context=multiprocessing.get_context('spawn'))
+                atexit.register(_import_pool.shutdown, wait=False)
+            except (OSError, ImportError, NotImplementedError):
+                # Some serverless runtimes cannot create the locks multiprocessing needs
+                app.logger.warning("Process pool unavailable, validating imports serially")
+                app.config['IMPORT_PROCESSES'] = 0
+        return _import_pool
+
+def iter_validated_chunks(chunks):
+    """Yield (chunk, valid, errors) for each chunk of (row_num, row) pairs, in order.
     
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(['Invoice', 'Medicine', 'Customer', 'Quantity', 'Unit Price', 
-                    'Discount', 'Tax', 'Total', 'Payment Method', 'Date'])
+    Files are validated inline unless IMPORT_PROCESSES is above 1, in which case
+    longer files fan out over the shared process pool, keeping at most two chunks
+    per worker in flight so memory stays bounded.
+    """
+    chunks = iter(chunks)
+    head = list(itertools.islice(chunks, 2))
     
-    for sale in sales:
-        writer.writerow([sale['invoice_number'], sale['medicine_name'], 
-                        sale['customer_name'] or 'Walk-in', sale['quantity'],
-                        sale['unit_price'], sale['discount'], sale['tax'],
-                        sale['total_price'], sale['payment_method'], sale['sale_date']])
+    pool = import_pool() if len(head) > 1 else None
+    if pool is None:
+        for chunk in itertools.chain(head, chunks):
+            yield (chunk, *validate_import_chunk(chunk))
+        return
     
-    output.seek(0)
-    return Response(output, mimetype='text/csv',
-                   headers={'Content-Disposition': f'attachment;filename=sales_report_{start_date}_to_{end_date}.csv'})
+    in_flight = deque()
+    for chunk in itertools.chain(head, chunks):
+        in_flight.append((chunk, pool.submit(validate_import_chunk, chunk)))
+        if len(in_flight) >= 2 * pool._max_workers:
+            chunk, future = in_flight.popleft()
+            yield (chunk, *future.result())
+    while in_flight:
+        chunk, future = in_flight.popleft()
+        yield (chunk, *future.result())
 
-# === CSV Import Medicine ===
+class ImportErrorReport:
+    """CSV of every rejected import row with its reason, written as errors occur.
+    
+    The file goes to EXPORT_FOLDER and is registered in the jobs table, so it is
+    downloaded, listed and expired exactly like a background export.
+    """
+    
+    def __init__(self):
+        self.path = None
+        self.file = None
+        self.writer = None
+        self.columns = None
+        self.count = 0
+    
+    def add(self, row_num, message, row):
+        if self.writer is None:
+            self.columns = [column for column in row if column is not None]
+            self.path = os.path.join(app.config['EXPORT_FOLDER'],
+                                     f"import_errors_{session['admin_id']}_{time.time_ns()}.csv")
+            self.file = open(self.path, 'w', newline='', encoding='utf-8')
+            self.writer = csv.writer(self.file)
+            self.writer.writerow(['row', 'error'] + self.columns)
+        self.writer.writerow([row_num, message] + [row.get(column) or '' for column in self.columns])
+        self.count += 1
+    
+    def save(self, file_name):
+        """Close the report and register it for download; returns the job id (None if empty)"""
+        if self.file is None:
+            return None
+        self.file.close()
+        now = datetime.now()
+        c = get_db().execute('''INSERT INTO jobs (kind, status, progress, total, file_path, file_name,
+                                                   created_by, created_at, finished_at, expires_at)
+                                VALUES ('import_errors', 'done', ?, ?, ?, ?, ?, ?, ?, ?)''',
+                             (self.count, self.count, self.path, file_name, session['admin_id'],
+                              now.strftime('%Y-%m-%d %H:%M:%S'), now.strftime('%Y-%m-%d %H:%M:%S'),
+                              (now + timedelta(hours=EXPORT_RETENTION_HOURS)).strftime('%Y-%m-%d %H:%M:%S')))
+        get_db().commit()
+        return c.lastrowid
+
+def write_import_rows(conn, pending, current, merge=False, add_quantity=False):
+    """Run the medicine and batch writes for (row_num, outcome, values) rows.
+    
+    `current` maps the barcode of each updated row to its medicine as it was before the import.
+    """
+    conn.executemany(MEDICINE_IMPORT_UPSERT if merge else MEDICINE_IMPORT_INSERT,
+                     [values for _, _, values in pending])
+    
+    updated = [(current[values[IMPORT_BARCODE]], values) for _, outcome, values in pending if outcome == 'updated']
+    if add_quantity:
+        conn.executemany(IMPORT_BATCH_RECEIVE, [
+            (*merged_labels(medicine, values), values[IMPORT_QUANTITY], values[IMPORT_COST_PRICE], values[IMPORT_BARCODE])
+            for medicine, values in updated if values[IMPORT_QUANTITY] > 0])
+        conn.executemany(IMPORT_ADJUSTMENT, [(values[IMPORT_QUANTITY], values[IMPORT_BARCODE])
+                                             for _, values in updated if values[IMPORT_QUANTITY] > 0])
+    elif updated:
+        # Only rows that give the lot a different batch number or expiry relabel it
+        relabels = [(*merged_labels(medicine, values), values[IMPORT_BARCODE]) for medicine, values in updated
+                    if merged_labels(medicine, values) != (medicine['batch_number'], medicine['expiry_date'])]
+        conn.execute("SAVEPOINT import_relabel")
+        try:
+            conn.executemany(IMPORT_BATCH_RELABEL, relabels)
+        except sqlite3.IntegrityError:
+            # A new label matches another lot of the same medicine: merge them one by one
+            conn.execute("ROLLBACK TO import_relabel")
+            for batch_number, expiry_date, barcode in relabels:
+                medicine = conn.execute("SELECT id FROM medicine WHERE barcode = ?", (barcode,)).fetchone()
+                relabel_batch(conn, medicine['id'], batch_number, expiry_date)
+        conn.execute("RELEASE import_relabel")
+
+def write_import_chunk(conn, rows, merge=False, add_quantity=False):
+    """Write validated (row_num, values) rows in one transaction.
+    
+    Returns a (row_num, outcome, message) triple per row, where outcome is 'inserted',
+    'updated', 'unchanged' or 'error'. With merge=True, rows whose barcode already
+    exists update that medicine through one upsert executemany instead of failing.
+    """
+    outcomes = []
+    
+    with write_transaction(conn):
+        current = {}
+        if merge:
+            barcodes = [values[IMPORT_BARCODE] for _, values in rows if values[IMPORT_BARCODE]]
+            current = {row['barcode']: row for row in conn.execute(
+                f'''SELECT barcode, quantity, {', '.join(IMPORT_MERGE_COLUMNS)} FROM medicine
+                    WHERE barcode IN (SELECT value FROM json_each(?))''', (json.dumps(barcodes),))}
+        
+        pending = []
+        for row_num, values in rows:
+            existing = current.get(values[IMPORT_BARCODE])
+            if existing is None:
+                pending.append((row_num, 'inserted', values))
+            elif merge_changes(existing, values, add_quantity):
+                pending.append((row_num, 'updated', values))
+            else:
+                outcomes.append((row_num, 'unchanged', ''))
+        
+        conn.execute("SAVEPOINT import_chunk")
+        try:
+            write_import_rows(conn, pending, current, merge, add_quantity)
+            outcomes.extend((row_num, outcome, '') for row_num, outcome, _ in pending)
+        except sqlite3.IntegrityError:
+            # Another writer took a barcode after the preload; retry row by row to isolate the failing rows
+            conn.execute("ROLLBACK TO import_chunk")
+            for row_num, outcome, values in pending:
+                conn.execute("SAVEPOINT import_row")
+                try:
+                    write_import_rows(conn, [(row_num, outcome, values)], current, merge, add_quantity)
+                    outcomes.append((row_num, outcome, ''))
+                except sqlite3.IntegrityError as e:
+                    conn.execute("ROLLBACK TO import_row")
+                    outcomes.append((row_num, 'error', str(e)))
+                conn.execute("RELEASE import_row")
+    return outcomes
 
 @app.route('/import_medicines', methods=['GET', 'POST'])
 @login_required
@@ -788,83 +2867,96 @@ def import_medicines():
             flash('Please upload a CSV file only!', 'danger')
             return redirect(request.url)
         
+        # 'insert' rejects barcodes that already exist; 'merge' updates those medicines
+        merge = request.form.get('mode') == 'merge'
+        add_quantity = merge and request.form.get('add_quantity') == '1'
+        
+        counts = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+        errors = []
+        report = ImportErrorReport()
+        report_name = f"import_errors_{secure_filename(file.filename) or 'medicines.csv'}"
+        
         try:
-            # Read CSV file
-            stream = io.StringIO(file.stream.read().decode("UTF8"), newline=None)
-            csv_reader = csv.DictReader(stream)
-            
-            success_count = 0
-            error_count = 0
-            errors = []
-            
             conn = get_db()
-            c = conn.cursor()
             
-            for row_num, row in enumerate(csv_reader, start=2):  # Start from 2 (header is row 1)
-                try:
-                    # Validate required fields
-                    if not row.get('name') or not row.get('brand') or not row.get('price'):
-                        errors.append(f"Row {row_num}: Missing required fields (name, brand, price)")
-                        error_count += 1
-                        continue
-                    
-                    # Check if barcode already exists (if provided)
-                    barcode = row.get('barcode', '').strip()
+            # One query each instead of a lookup per row
+            existing_barcodes = set() if merge else {row[0] for row in conn.execute(
+                "SELECT barcode FROM medicine WHERE barcode IS NOT NULL AND barcode != ''")}
+            # Without a barcode, an existing name + brand counts as the same medicine
+            existing_names = {(row[0].lower(), row[1].lower()) for row in conn.execute(
+                "SELECT name, brand FROM medicine WHERE name IS NOT NULL AND brand IS NOT NULL")}
+            barcode_rows = {}  # barcode -> first row in this file that used it
+            
+            for chunk, valid, chunk_errors in iter_validated_chunks(iter_import_chunks(file)):
+                rows = []
+                for row_num, values in valid:
+                    name, brand, barcode = values[0], values[2], values[9]
                     if barcode:
-                        c.execute("SELECT id FROM medicine WHERE barcode=?", (barcode,))
-                        if c.fetchone():
-                            errors.append(f"Row {row_num}: Barcode {barcode} already exists")
-                            error_count += 1
+                        if barcode in barcode_rows:
+                            chunk_errors.append((row_num, f"Barcode {barcode} duplicates row {barcode_rows[barcode]}"))
                             continue
-                    
-                    # Insert medicine
-                    c.execute('''INSERT INTO medicine 
-                                (name, generic_name, brand, category, quantity, reorder_level,
-                                 cost_price, price, expiry_date, barcode, batch_number, rack_location, 
-                                 description, requires_prescription)
-                                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                             (row.get('name', '').strip(),
-                              row.get('generic_name', '').strip() or None,
-                              row.get('brand', '').strip(),
-                              row.get('category', '').strip() or None,
-                              int(row.get('quantity', 0) or 0),
-                              int(row.get('reorder_level', 10) or 10),
-                              float(row.get('cost_price', 0) or 0) or None,
-                              float(row.get('price', 0)),
-                              row.get('expiry_date', '').strip() or None,
-                              barcode or None,
-                              row.get('batch_number', '').strip() or None,
-                              row.get('rack_location', '').strip() or None,
-                              row.get('description', '').strip() or None,
-                              1 if str(row.get('requires_prescription', '0')).strip() == '1' else 0))
-                    
-                    success_count += 1
-                    
-                except Exception as e:
-                    errors.append(f"Row {row_num}: {str(e)}")
-                    error_count += 1
-            
-            conn.commit()
-            conn.close()
-            
-            log_activity('Import Medicines', f"Imported {success_count} medicines, {error_count} errors")
-            
-            # Show results
-            if success_count > 0:
-                flash(f'✅ Successfully imported {success_count} medicines!', 'success')
-            
-            if error_count > 0:
-                flash(f'⚠️ {error_count} rows had errors. Check details below.', 'warning')
-                for error in errors[:10]:  # Show first 10 errors
-                    flash(error, 'danger')
-                if len(errors) > 10:
-                    flash(f'... and {len(errors) - 10} more errors', 'danger')
-            
-            return redirect(url_for('medicines'))
+                        if barcode in existing_barcodes:
+                            chunk_errors.append((row_num, f"Barcode {barcode} already exists"))
+                            continue
+                        barcode_rows[barcode] = row_num
+                    else:
+                        key = (name.lower(), brand.lower())
+                        if key in existing_names:
+                            chunk_errors.append((row_num, f"Medicine {name} ({brand}) already exists"))
+                            continue
+                        existing_names.add(key)
+                    rows.append((row_num, values))
+                
+                if rows:
+                    for row_num, outcome, message in write_import_chunk(conn, rows, merge, add_quantity):
+                        if outcome == 'error':
+                            chunk_errors.append((row_num, message))
+                        else:
+                            counts[outcome] += 1
+                
+                chunk_errors.sort()
+                rows_by_num = dict(chunk)
+                for row_num, error in chunk_errors:
+                    report.add(row_num, error, rows_by_num[row_num])
+                # Only the first few are shown on screen; the report has the rest
+                errors.extend(chunk_errors[:10 - len(errors)])
             
         except Exception as e:
             flash(f'Error reading CSV file: {str(e)}', 'danger')
-            return redirect(request.url)
+            if not counts['inserted'] and not counts['updated']:
+                report.save(report_name)
+                return redirect(request.url)
+        
+        if counts['inserted'] or counts['updated']:
+            invalidate_barcode_index()
+            invalidate_cache('catalog', 'stock')
+        
+        error_count = report.count
+        report_id = report.save(report_name)
+        if merge:
+            log_activity('Import Medicines', f"Merged catalogue: {counts['inserted']} inserted, {counts['updated']} updated, "
+                                             f"{counts['unchanged']} unchanged, {error_count} errors")
+        else:
+            log_activity('Import Medicines', f"Imported {counts['inserted']} medicines, {error_count} errors")
+        
+        # Show results
+        if merge:
+            flash(f"✅ Catalogue merged: {counts['inserted']} added, {counts['updated']} updated, "
+                  f"{counts['unchanged']} unchanged.", 'success')
+        elif counts['inserted'] > 0:
+            flash(f"✅ Successfully imported {counts['inserted']} medicines!", 'success')
+        
+        if error_count > 0:
+            flash(f'⚠️ {error_count} rows had errors. Check details below.', 'warning')
+            for row_num, error in errors:  # Show first 10 errors
+                flash(f"Row {row_num}: {error}", 'danger')
+            if error_count > 10:
+                flash(f'... and {error_count - 10} more errors', 'danger')
+            if report_id:
+                flash(Markup(f'<a href="{escape(url_for("download_export_job", job_id=report_id))}">'
+                             f'Download the error report</a> listing all {error_count} rejected rows and why.'), 'info')
+        
+        return redirect(url_for('medicines'))
     
     return render_template('import_medicines.html')
 
@@ -950,15 +3042,23 @@ def activity_log():
 @app.route('/notifications')
 @login_required
 def notifications():
-    all_notifications = query_db("SELECT * FROM notifications ORDER BY created_at DESC")
-    return render_template('notifications.html', notifications=all_notifications)
+    notifications, pagination = keyset_page("SELECT * FROM notifications WHERE 1=1", [], 'created_at', descending=True)
+    return render_template('notifications.html', notifications=notifications, pagination=pagination)
 
 @app.route('/mark_notification_read/<int:notif_id>')
 @login_required
 def mark_notification_read(notif_id):
     query_db("UPDATE notifications SET is_read=1 WHERE id=?", (notif_id,))
+    invalidate_cache('notifications')
     return redirect(url_for('notifications'))
 
+# === Cache Statistics ===
+
+@app.route('/api/cache_stats')
+@login_required
+def cache_stats():
+    return jsonify(query_cache.stats())
+
 # === Logout ===
 
 @app.route('/logout')
@@ -968,5 +3068,113 @@ def logout():
     flash('You have been logged out successfully.', 'info')
     return redirect(url_for('login'))
 
+# === Maintenance Commands ===
+# Run with `flask --app app <command>` (or `--app main` for the Vercel entry point)
+
+def rebuild_sales_summary(conn):
+    """Recompute daily_sales_summary from the invoice headers in one transaction"""
+    with write_transaction(conn):
+        conn.execute("DELETE FROM daily_sales_summary")
+        conn.execute(f"INSERT INTO daily_sales_summary {SALES_SUMMARY_ROLLUP}")
+
+def check_sales_summary(conn):
+    """Return the days on which daily_sales_summary disagrees with the invoices"""
+    return conn.execute(f'''
+        WITH expected (sale_day, revenue, items, invoice_count, tax, discount) AS ({SALES_SUMMARY_ROLLUP})
+        SELECT e.sale_day, e.revenue as expected_revenue, d.revenue as summary_revenue,
+               e.invoice_count as expected_invoices, d.invoice_count as summary_invoices
+        FROM expected e
+        LEFT JOIN daily_sales_summary d ON d.sale_day = e.sale_day
+        WHERE d.sale_day IS NULL
+           OR d.items != e.items OR d.invoice_count != e.invoice_count
+           OR ABS(d.revenue - e.revenue) > 0.005 OR ABS(d.tax - e.tax) > 0.005
+           OR ABS(d.discount - e.discount) > 0.005
+        UNION ALL
+        SELECT d.sale_day, 0, d.revenue, 0, d.invoice_count
+        FROM daily_sales_summary d
+        WHERE NOT EXISTS (SELECT 1 FROM invoices
+                          WHERE sale_date >= d.sale_day AND sale_date < DATE(d.sale_day, '+1 day'))
+        ORDER BY 1
+    ''').fetchall()
+
+@app.cli.command('purge-notifications')
+@click.option('--days', default=NOTIFICATION_RETENTION_DAYS, show_default=True,
+              help='Keep read notifications newer than this many days.')
+def purge_notifications_command(days):
+    """Delete old read notifications."""
+    conn = connect_db()
+    deleted = purge_read_notifications(conn, days)
+    conn.close()
+    click.echo(f"Deleted {deleted} read notifications older than {days} days")
+
+@app.cli.command('purge-exports')
+def purge_exports_command():
+    """Delete expired background export files."""
+    conn = connect_db()
+    deleted = purge_expired_exports(conn)
+    conn.close()
+    click.echo(f"Deleted {deleted} expired export jobs")
+
+@app.cli.command('snapshot-stock')
+def snapshot_stock_command():
+    """Snapshot stock balances for point-in-time valuation."""
+    conn = connect_db()
+    taken = snapshot_stock(conn)
+    conn.close()
+    click.echo(f"Snapshotted stock for {taken} medicines")
+
+@app.cli.command('reconcile-stock')
+@click.option('--apply', is_flag=True, help='Record the differences as corrective adjustments.')
+def reconcile_stock_command(apply):
+    """Compare stock with what sales and adjustments imply."""
+    conn = connect_db()
+    mismatches = reconcile_stock(conn, apply=apply)
+    conn.close()
+    
+    if not mismatches:
+        click.echo("Stock is consistent with sales and adjustments")
+        return
+    for row in mismatches:
+        click.echo(f"{row['name']} (ID {row['medicine_id']}): expected {row['expected']}, "
+                   f"stock is {row['actual']} ({row['difference']:+d})")
+    if apply:
+        click.echo(f"Recorded corrective adjustments for {len(mismatches)} medicines")
+    else:
+        raise SystemExit(1)
+
+@app.cli.command('scan-stock')
+def scan_stock_command():
+    """Rebuild expiry and low-stock alerts now."""
+    conn = connect_db()
+    counts = scan_stock_alerts(conn)
+    conn.close()
+    click.echo(f"{counts.get('expired', 0)} expired and {counts.get('expiring', 0)} expiring batches, "
+               f"{counts.get('low_stock', 0)} low-stock medicines")
+
+@app.cli.command('rebuild-sales-summary')
+def rebuild_sales_summary_command():
+    """Rebuild the daily sales summary from all invoices."""
+    conn = connect_db()
+    rebuild_sales_summary(conn)
+    days = conn.execute("SELECT COUNT(*) FROM daily_sales_summary").fetchone()[0]
+    conn.close()
+    click.echo(f"Rebuilt daily sales summary: {days} days")
+
+@app.cli.command('check-sales-summary')
+def check_sales_summary_command():
+    """Compare the daily sales summary against the invoices."""
+    conn = connect_db()
+    mismatches = check_sales_summary(conn)
+    conn.close()
+    
+    if not mismatches:
+        click.echo("Daily sales summary is consistent")
+        return
+    for row in mismatches:
+        click.echo(f"{row['sale_day']}: expected {row['expected_revenue']:.2f} over {row['expected_invoices']} invoices, "
+                   f"summary has {row['summary_revenue'] or 0:.2f} over {row['summary_invoices'] or 0}")
+    raise SystemExit(1)
+
 if __name__ == '__main__':
+    multiprocessing.freeze_support()
     app.run(debug=True, port=5002)
@@ -0,0 +1,80 @@
+"""Validation of CSV medicine import rows.
+
+Kept apart from the Flask app and free of import-time side effects, so import
+worker processes can load it without opening the database or running migrations.
+"""
+import math
+import re
+from datetime import datetime
+
+IMPORT_COLUMNS = ['name', 'generic_name', 'brand', 'category', 'quantity', 'reorder_level',
+                  'cost_price', 'price', 'expiry_date', 'barcode', 'batch_number',
+                  'rack_location', 'description', 'requires_prescription']
+
+# Accepted (type, min, max) for numeric columns
+IMPORT_NUMBER_RANGES = {
+    'quantity': (int, 0, 1_000_000),
+    'reorder_level': (int, 0, 1_000_000),
+    'cost_price': (float, 0, 10_000_000),
+    'price': (float, 0, 10_000_000),
+}
+IMPORT_DATE_PATTERN = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+
+def parse_import_number(column, value, default):
+    if not value:
+        return default
+    cast, low, high = IMPORT_NUMBER_RANGES[column]
+    try:
+        number = cast(value)
+    except ValueError:
+        kind = 'a whole number' if cast is int else 'a number'
+        raise ValueError(f"{column} must be {kind}, got '{value}'")
+    if not math.isfinite(number) or not low <= number <= high:
+        raise ValueError(f"{column} must be between {low:,} and {high:,}, got {value}")
+    return number
+
+def parse_import_date(column, value):
+    if not value:
+        return None
+    try:
+        if not IMPORT_DATE_PATTERN.match(value):
+            raise ValueError
+        datetime.fromisoformat(value)  # rejects impossible dates such as 2026-02-30
+    except ValueError:
+        raise ValueError(f"{column} must be a YYYY-MM-DD date, got '{value}'")
+    return value
+
+def parse_import_row(row):
+    """Convert one CSV row into a tuple of IMPORT_COLUMNS values, raising ValueError if invalid"""
+    def field(name):
+        return (row.get(name) or '').strip()
+
+    if not field('name') or not field('brand') or not field('price'):
+        raise ValueError("Missing required fields (name, brand, price)")
+    if field('requires_prescription') not in ('', '0', '1'):
+        raise ValueError(f"requires_prescription must be 0 or 1, got '{field('requires_prescription')}'")
+
+    return (field('name'),
+            field('generic_name') or None,
+            field('brand'),
+            field('category') or None,
+            parse_import_number('quantity', field('quantity'), 0),
+            parse_import_number('reorder_level', field('reorder_level'), 10),
+            parse_import_number('cost_price', field('cost_price'), 0) or None,
+            parse_import_number('price', field('price'), None),
+            parse_import_date('expiry_date', field('expiry_date')),
+            field('barcode') or None,
+            field('batch_number') or None,
+            field('rack_location') or None,
+            field('description') or None,
+            1 if field('requires_prescription') == '1' else 0)
+
+def validate_import_chunk(chunk):
+    """Parse a chunk of (row_num, row) pairs into valid (row_num, values) and (row_num, error) lists"""
+    valid, errors = [], []
+    for row_num, row in chunk:
+        try:
+            valid.append((row_num, parse_import_row(row)))
+        except ValueError as e:
+            errors.append((row_num, str(e)))
+    return valid, errors
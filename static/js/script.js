@@ -83,6 +83,15 @@ function searchTable(inputId, tableId) {
     }
 }
 
+// Delay calls until input has paused for `wait` milliseconds
+function debounce(func, wait = 250) {
+    let timeout;
+    return function(...args) {
+        clearTimeout(timeout);
+        timeout = setTimeout(() => func.apply(this, args), wait);
+    };
+}
+
 // Form validation
 function validateForm(formId) {
     const form = document.getElementById(formId);
@@ -0,0 +1,20 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# main.py keeps its database under /tmp; importing app.py would create and migrate
+# pharmacy.db in the working directory
+import main
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """A fresh database built by init_db(), which applies every migration"""
+    monkeypatch.setattr(main, 'DB', str(tmp_path / 'pharmacy.db'))
+    main.init_db()
+    conn = main.connect_db()
+    yield conn
+    conn.close()
@@ -0,0 +1,33 @@
+"""AuditWriter must write every queued row before flush() or stop() returns"""
+import pytest
+
+import main
+
+ROWS = 250  # several batches
+
+
+@pytest.fixture
+def writer(db, monkeypatch):
+    monkeypatch.setitem(main.app.config, 'SYNC_AUDIT_WRITES', False)
+    writer = main.AuditWriter()
+    yield writer
+    writer.stop()
+
+
+def queue_notifications(writer):
+    for i in range(ROWS):
+        writer.submit("INSERT INTO notifications (type, message) VALUES (?, ?)", ('info', f'row {i}'),
+                      tags=('notifications',))
+
+
+def test_flush_waits_for_queued_rows(db, writer):
+    queue_notifications(writer)
+    writer.flush()
+    assert db.execute("SELECT COUNT(*) FROM notifications").fetchone()[0] == ROWS
+
+
+def test_stop_drains_queued_rows(db, writer):
+    queue_notifications(writer)
+    writer.stop()
+    assert db.execute("SELECT COUNT(*) FROM notifications").fetchone()[0] == ROWS
+    assert not writer._thread.is_alive()
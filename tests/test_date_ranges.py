@@ -0,0 +1,60 @@
+"""date_range_bounds must select exactly the rows the old DATE(sale_date) filters did"""
+from datetime import datetime
+
+import pytest
+
+import main
+
+# Around each edge: the first and last instants of a day, written the ways sale_date
+# ends up stored (datetime.now() keeps microseconds, CURRENT_TIMESTAMP does not)
+EDGE_DAYS = ['2023-12-31', '2024-01-01', '2024-01-31', '2024-02-01', '2024-02-28', '2024-02-29',
+             '2024-03-01', '2025-12-31', '2026-01-01']
+TIMES = [' 00:00:00', ' 00:00:00.000001', ' 12:30:00', ' 23:59:59', ' 23:59:59.999999', 'T23:59:59', '']
+
+RANGES = [
+    pytest.param('2024-02-29', None, id='leap-day'),
+    pytest.param('2024-01-31', '2024-01-31', id='month-end-day'),
+    pytest.param('2024-02-01', '2024-02-29', id='february-leap-year'),
+    pytest.param('2024-01-01', '2024-01-31', id='january'),
+    pytest.param('2023-12-31', '2024-01-01', id='across-new-year'),
+    pytest.param('2025-12-31', None, id='year-end-day'),
+    pytest.param('2024-01-01', '2025-12-31', id='two-years'),
+    pytest.param('2024-03-01', '2024-02-01', id='reversed'),
+]
+
+
+@pytest.fixture
+def sales(db):
+    sale_dates = [day + time for day in EDGE_DAYS for time in TIMES]
+    sale_dates.append(datetime(2024, 2, 29, 23, 59, 59, 999999))  # stored by the sqlite3 adapter
+    db.executemany("INSERT INTO invoices (invoice_number, sale_date) VALUES (?, ?)",
+                   [(f'INV{n}', sale_date) for n, sale_date in enumerate(sale_dates)])
+    db.commit()
+    return db
+
+
+def matching(conn, where, params):
+    return {row['id'] for row in conn.execute(f"SELECT id FROM invoices WHERE {where}", params)}
+
+
+@pytest.mark.parametrize('start_date, end_date', RANGES)
+def test_bounds_match_date_between(sales, start_date, end_date):
+    bounds = main.date_range_bounds(start_date, end_date)
+    expected = matching(sales, "DATE(sale_date) BETWEEN ? AND ?", (start_date, end_date or start_date))
+    assert expected or start_date > (end_date or start_date)  # only a reversed range selects nothing
+    assert matching(sales, "sale_date >= ? AND sale_date < ?", bounds) == expected
+    if end_date is None:
+        assert matching(sales, "DATE(sale_date) = ?", (start_date,)) == expected
+
+
+def test_bounds_are_half_open_days():
+    assert main.date_range_bounds('2024-02-29') == ('2024-02-29', '2024-03-01')
+    assert main.date_range_bounds('2023-02-01', '2023-02-28') == ('2023-02-01', '2023-03-01')
+    assert main.date_range_bounds('2025-12-01', '2025-12-31') == ('2025-12-01', '2026-01-01')
+
+
+@pytest.mark.parametrize('start_date, end_date', [('2024-02-30', None), ('2024-13-01', None),
+                                                  ('2024-01-01', 'not a date'), ('', None)])
+def test_invalid_dates_raise(start_date, end_date):
+    with pytest.raises(ValueError):
+        main.date_range_bounds(start_date, end_date)
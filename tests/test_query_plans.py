@@ -0,0 +1,151 @@
+"""Each index the migrations add must show up in the plan of the queries it serves.
+
+The SQL is the route's own: module constants where main.py has them, otherwise
+the query as written in the route.
+"""
+import pytest
+
+import main
+
+MONTH = ('2026-01-01', '2026-02-01')
+
+ROUTE_QUERIES = [
+    # dashboard / sales_report / export_sales
+    pytest.param('''SELECT COALESCE(SUM(total), 0) as total_sales, COALESCE(SUM(item_count), 0) as total_items
+                    FROM invoices
+                    WHERE sale_date >= ? AND sale_date < ?''', MONTH,
+                 ['idx_invoices_date_totals'], id='sales_report-totals'),
+    pytest.param('''SELECT s.*, m.name as medicine_name, c.name as customer_name
+                    FROM sales s
+                    JOIN medicine m ON s.medicine_id = m.id
+                    LEFT JOIN customers c ON s.customer_id = c.id
+                    WHERE s.sale_date >= ? AND s.sale_date < ?
+                    ORDER BY s.sale_date DESC''', MONTH,
+                 ['idx_invoices_date_totals', 'idx_invoice_items_invoice_id'], id='export_sales'),
+    pytest.param("SELECT COUNT(*) FROM sales WHERE sale_date >= ? AND sale_date < ?", MONTH,
+                 ['idx_invoices_date_totals'], id='export_job-count'),
+    pytest.param('''SELECT s.*, m.name, c.name as customer_name
+                    FROM (SELECT id FROM invoices ORDER BY sale_date DESC LIMIT 10) recent
+                    JOIN sales s ON s.invoice_id = recent.id
+                    JOIN medicine m ON s.medicine_id = m.id
+                    LEFT JOIN customers c ON s.customer_id = c.id
+                    ORDER BY s.sale_date DESC
+                    LIMIT 10''', (),
+                 ['idx_invoices_date_totals', 'idx_invoice_items_invoice_id'], id='dashboard-recent_sales'),
+    pytest.param("SELECT * FROM notifications WHERE is_read=0 ORDER BY created_at DESC LIMIT 5", (),
+                 ['idx_notifications_unread'], id='dashboard-notifications'),
+    pytest.param("SELECT COUNT(*) as count FROM medicine WHERE is_low_stock", (),
+                 ['idx_medicine_low_stock'], id='dashboard-low_stock'),
+    pytest.param("SELECT kind, COUNT(DISTINCT medicine_id) as count FROM stock_alerts GROUP BY kind", (),
+                 ['idx_stock_alerts_kind'], id='dashboard-alerts'),
+    # analytics
+    pytest.param('''SELECT m.name, SUM(s.quantity) as total_sold, SUM(s.total_price) as revenue
+                    FROM sales s
+                    JOIN medicine m ON s.medicine_id = m.id
+                    GROUP BY s.medicine_id
+                    ORDER BY total_sold DESC
+                    LIMIT 10''', (),
+                 ['idx_invoice_items_medicine_id'], id='analytics-top_medicines'),
+    # medicines list: category filter, category dropdown and each sort column
+    pytest.param("SELECT * FROM medicine WHERE 1=1 AND category = ? ORDER BY name ASC, id ASC LIMIT ?", ('Antibiotic', 21),
+                 ['idx_medicine_category'], id='medicines-category'),
+    pytest.param("SELECT DISTINCT category FROM medicine WHERE category IS NOT NULL", (),
+                 ['idx_medicine_category'], id='medicines-categories'),
+    *[pytest.param(f"SELECT * FROM medicine WHERE 1=1 ORDER BY {column} ASC, id ASC LIMIT ?", (21,),
+                   [index], id=f'medicines-sort-{column}')
+      for column, index in [('name', 'idx_medicine_name'), ('brand', 'idx_medicine_brand'),
+                            ('price', 'idx_medicine_price'), ('expiry_date', 'idx_medicine_expiry_date')]],
+    pytest.param("SELECT * FROM medicine WHERE 1=1 AND (name > ? OR (name = ? AND id > ?)) ORDER BY name ASC, id ASC LIMIT ?",
+                 ('Amoxil', 'Amoxil', 7, 21), ['idx_medicine_name'], id='medicines-next_page'),
+    # inventory
+    pytest.param('''SELECT m.*, s.name as supplier_name,
+                           (SELECT COUNT(*) FROM medicine_batches WHERE medicine_id = m.id AND quantity > 0) as batch_count
+                    FROM medicine m
+                    LEFT JOIN suppliers s ON m.supplier_id = s.id
+                    WHERE m.is_low_stock
+                    ORDER BY m.quantity ASC''', (),
+                 ['idx_medicine_low_stock', 'idx_medicine_batches_fefo'], id='low_stock'),
+    pytest.param('''SELECT b.id as batch_id, b.batch_number, b.quantity, b.expiry_date, m.id, m.name
+                    FROM stock_alerts a
+                    JOIN medicine_batches b ON b.id = a.batch_id
+                    JOIN medicine m ON m.id = b.medicine_id
+                    WHERE a.kind = ? AND b.quantity > 0
+                    ORDER BY b.expiry_date''', ('expired',),
+                 ['idx_stock_alerts_kind'], id='expired'),
+    pytest.param(main.STOCK_ALERT_SCAN, {'horizon': '2026-02-01', 'today': '2026-01-01'},
+                 ['idx_medicine_batches_fefo'], id='stock_alert_scan'),
+    pytest.param("SELECT * FROM inventory_adjustments WHERE adjustment_date >= ?", ('2026-01-01',),
+                 ['idx_inventory_adjustments_date'], id='inventory_adjustments-since'),
+    pytest.param(main.STOCK_RECONCILIATION, (),
+                 ['idx_stock_snapshots_opening', 'idx_inventory_adjustments_date'], id='reconciliation'),
+    # till: FEFO picking, barcode index refresh and lot lookups
+    pytest.param(main.FEFO_ALLOCATION, ('{"1": 2}', 0, '2026-01-01'),
+                 ['idx_medicine_batches_fefo'], id='pos-fefo'),
+    pytest.param(f"{main.BARCODE_INDEX_QUERY} AND id IN (?)", (1,),
+                 ['idx_medicine_batches_fefo'], id='barcode_index-refresh'),
+    pytest.param(f"SELECT m.id, {main.SELLABLE_QUANTITY} as sellable FROM medicine m WHERE m.id IN (?)", (1,),
+                 ['idx_medicine_batches_fefo'], id='pos-sellable'),
+    pytest.param(main.BATCH_TO_RELABEL, (1,), ['idx_medicine_batches_fefo'], id='edit_medicine-relabel'),
+    pytest.param(main.BATCH_LOT, (1, 'B1', '2027-01-01'), ['idx_medicine_batches_lot'], id='edit_medicine-lot'),
+    # lists ordered for keyset paging
+    pytest.param("SELECT * FROM notifications WHERE 1=1 ORDER BY created_at DESC, id DESC LIMIT ?", (21,),
+                 ['idx_notifications_created_at'], id='notifications'),
+    pytest.param('''SELECT a.*, ad.full_name
+                    FROM activity_log a
+                    JOIN admin ad ON a.user_id = ad.id
+                    ORDER BY a.timestamp DESC
+                    LIMIT 100''', (),
+                 ['idx_activity_log_timestamp'], id='activity_log'),
+    pytest.param("SELECT * FROM suppliers WHERE 1=1 ORDER BY name ASC, id ASC LIMIT ?", (21,),
+                 ['idx_suppliers_name'], id='suppliers'),
+    pytest.param("SELECT * FROM customers WHERE 1=1 ORDER BY name ASC, id ASC LIMIT ?", (21,),
+                 ['idx_customers_name'], id='customers'),
+    pytest.param('''SELECT po.*, s.name as supplier_name, a.full_name as created_by_name
+                    FROM purchase_orders po
+                    JOIN suppliers s ON po.supplier_id = s.id
+                    LEFT JOIN admin a ON po.created_by = a.id
+                    WHERE 1=1 ORDER BY po.order_date DESC, po.id DESC LIMIT ?''', (21,),
+                 ['idx_purchase_orders_order_date'], id='purchase_orders'),
+    pytest.param("SELECT * FROM jobs WHERE created_by=? ORDER BY created_at DESC, id DESC LIMIT 50", (1,),
+                 ['idx_jobs_created_by'], id='export_jobs'),
+    pytest.param('''SELECT id, file_path FROM jobs
+                    WHERE expires_at < ? OR (expires_at IS NULL AND created_at < ?)''', ('2026-01-02', '2026-01-01'),
+                 ['idx_jobs_expires_at'], id='purge_exports'),
+    # foreign key lookups (PO lines, a customer's or cashier's invoices)
+    pytest.param("SELECT * FROM po_items WHERE po_id = ?", (1,), ['idx_po_items_po_id'], id='po_items'),
+    pytest.param("SELECT * FROM invoices WHERE customer_id = ?", (1,), ['idx_invoices_customer_id'], id='customer_invoices'),
+    pytest.param("SELECT * FROM invoices WHERE cashier_id = ?", (1,), ['idx_invoices_cashier_id'], id='cashier_invoices'),
+]
+
+
+def query_plan(conn, sql, params=()):
+    return [row['detail'] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+
+
+@pytest.mark.parametrize('sql, params, indexes', ROUTE_QUERIES)
+def test_route_query_uses_index(db, sql, params, indexes):
+    plan = query_plan(db, sql, params)
+    for index in indexes:
+        assert any(f'INDEX {index}' in step for step in plan), f"{index} not used:\n" + '\n'.join(plan)
+
+
+def test_stock_at_one_medicine_stays_on_indexes(db):
+    ids = ' UNION '.join(f"SELECT {column} FROM {table} WHERE {column} = :medicine_id"
+                         for table, column in main.STOCK_AT_MEDICINES)
+    plan = query_plan(db, main.STOCK_AT.format(ids=ids), {'at': '2026-01-01', 'medicine_id': 1})
+    assert any('INDEX idx_stock_snapshots_medicine' in step for step in plan), plan
+    assert any('INDEX idx_stock_movements_medicine' in step for step in plan), plan
+    assert not any(step.startswith('SCAN stock_') for step in plan), plan
+
+
+def test_sale_date_range_does_not_scan_invoices(db):
+    plan = query_plan(db, "SELECT * FROM sales WHERE sale_date >= ? AND sale_date < ?", MONTH)
+    assert not any(step.startswith('SCAN') for step in plan), plan
+
+
+def test_migrations_are_recorded_once(db):
+    versions = [row['version'] for row in db.execute("SELECT version FROM schema_version ORDER BY version")]
+    assert versions == [version for version, _, _ in main.MIGRATIONS]
+    
+    main.migrate_db(db)
+    assert db.execute("SELECT COUNT(*) FROM schema_version").fetchone()[0] == len(main.MIGRATIONS)